@@ -1,11 +1,21 @@
 import streamlit as st
+import os
+import re
+import json
 import math
+import time
+import random
+import atexit
+import threading
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 from io import BytesIO
 from pathlib import Path
 from datetime import datetime
 from calendar import monthrange
 import gspread
+from openpyxl import Workbook, load_workbook
 from google.oauth2.service_account import Credentials
 
 # 🔗 GOOGLE SHEET CONFIG
@@ -22,31 +32,429 @@ def get_gsheet_client():
     )
     return gspread.authorize(creds)
 
+# Sheets API budget for the whole process (all sessions plus the background writer)
+SHEETS_RATE_PER_SECOND = 1.0     # sustained calls per second
+SHEETS_BURST = 10                # calls allowed back to back before the rate applies
+SHEETS_MAX_RETRIES = 5           # retries of a call rejected with 429 / 5xx
+SHEETS_BACKOFF_SECONDS = 1.0     # first backoff ceiling, doubled per retry ...
+SHEETS_BACKOFF_CAP_SECONDS = 32  # ... up to this
+
+class SheetsRateLimiter:
+    """
+    Token bucket in front of every Google Sheets API call, shared by all
+    sessions. Calls that find the bucket empty wait for their token
+    (throttled); calls rejected for quota (429) or a server error (5xx)
+    are retried after a jittered exponential backoff. A 5xx doesn't say
+    whether the request was applied, so calls that are not idempotent
+    (deleting rows by index, appending) are only retried on a 429.
+    """
+
+    def __init__(self, rate: float = SHEETS_RATE_PER_SECOND, burst: int = SHEETS_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.calls = 0      # API calls made, retries included
+        self.throttled = 0  # calls that had to wait for a token
+        self.retried = 0    # calls repeated after a 429 / 5xx
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until it is due. Waiters are served in order."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            self.calls += 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if wait:
+                self.throttled += 1
+        if wait:
+            time.sleep(wait)
+
+    def call(self, func, *args, idempotent: bool = True, **kwargs):
+        """func(*args, **kwargs) within the rate, retrying quota and server errors."""
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            self.acquire()
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code
+                if attempt == SHEETS_MAX_RETRIES or not (status == 429 or (idempotent and status >= 500)):
+                    raise
+            with self._lock:
+                self.retried += 1
+            # Full jitter: sessions that failed together don't retry together
+            ceiling = min(SHEETS_BACKOFF_CAP_SECONDS, SHEETS_BACKOFF_SECONDS * 2 ** attempt)
+            time.sleep(random.uniform(0, ceiling))
+
+@st.cache_resource
+def get_sheets_limiter() -> SheetsRateLimiter:
+    return SheetsRateLimiter()
+
+def sheets_call(func, *args, idempotent: bool = True, **kwargs):
+    """Make one Sheets API call through the shared rate limiter."""
+    return get_sheets_limiter().call(func, *args, idempotent=idempotent, **kwargs)
+
+@st.cache_resource
+def get_sheet_handles() -> dict:
+    """
+    Opened gspread objects, shared by all sessions: the Spreadsheet per
+    sheet_id and the Worksheet per (sheet_id, tab). Opening either costs an
+    API round-trip, so it happens once, not on every read and write.
+    """
+    return {}
+
+def get_spreadsheet(sheet_id: str) -> gspread.Spreadsheet:
+    handles = get_sheet_handles()
+    if sheet_id not in handles:
+        handles[sheet_id] = sheets_call(get_gsheet_client().open_by_key, sheet_id)
+    return handles[sheet_id]
+
+def get_worksheet(sheet_id: str, tab: str) -> gspread.Worksheet:
+    handles = get_sheet_handles()
+    if (sheet_id, tab) not in handles:
+        handles[(sheet_id, tab)] = sheets_call(get_spreadsheet(sheet_id).worksheet, tab)
+    return handles[(sheet_id, tab)]
+
+def forget_worksheet(sheet_id: str, tab: str):
+    """Drop a cached worksheet so the next call reopens it (after errors or row deletes)."""
+    get_sheet_handles().pop((sheet_id, tab), None)
+
+@st.cache_resource
+def get_synced_frames() -> dict:
+    """
+    Last values known to be in each worksheet, keyed by (sheet_id, tab).
+    Shared by all sessions so every write can be diffed against it.
+    """
+    return {}
+
+@st.cache_resource
+def get_sheet_texts() -> dict:
+    """
+    Sheet cells whose text is not how the typed master renders them, keyed
+    by (sheet_id, tab): (header, texts, kept). read_sheet stores the raw
+    `texts`; on first use they are reduced to `kept`, a frame of those cells
+    by S.NO with their rendering and original text. Unlike the synced
+    frames this survives failed writes: we never write such cells unless
+    they were edited in the app.
+    """
+    return {}
+
+def keep_sheet_text(header: list, body: np.ndarray, key: tuple) -> tuple[np.ndarray, pd.DataFrame]:
+    """
+    body with each cell that still renders as its sheet text did when
+    parsed put back as that original text, so values clean_dataframe
+    cannot represent (two numbers in a contact cell, "Y" flags, other
+    status words, …) are not blanked by writes. Also returns the cells
+    kept this way, for get_sheet_texts once the write succeeds.
+    """
+    known = get_sheet_texts().get(key)
+    if known is None or known[0] != header or "S.NO" not in header:
+        return body, pd.DataFrame(columns=["S.NO", "col", "rendered", "text"])
+    _, texts, kept = known
+    k = header.index("S.NO")
+    if kept is None:
+        # Parse the texts as read_sheet + clean_dataframe did, once per distinct text
+        parsed = clean_dataframe(pd.DataFrame({
+            j: _per_unique(pd.Series(texts[:, j]), lambda u: u.map(gspread.utils.numericise, na_action="ignore"))
+            for j in range(len(header))
+        }).set_axis(header, axis=1))
+        rendered = to_sheet_frame(parsed[header]).to_numpy(dtype=object).reshape(texts.shape)
+        rows, cols = np.nonzero(rendered != texts)
+        kept = pd.DataFrame({
+            "S.NO": rendered[rows, k], "col": cols,
+            "rendered": rendered[rows, cols], "text": texts[rows, cols],
+        })
+        get_sheet_texts()[key] = (header, None, kept)
+    if kept.empty:
+        return body, kept
+
+    row_of = pd.Series(np.arange(len(body)), index=body[:, k])
+    rows = kept["S.NO"].map(row_of[~row_of.index.duplicated()])
+    kept, rows = kept[rows.notna()], rows.dropna().astype(np.intp).to_numpy()
+    cols = kept["col"].to_numpy()
+    # A cell edited in the app since no longer renders as before: it is written
+    same = body[rows, cols] == kept["rendered"].to_numpy()
+    kept = kept[same]
+    out = body.copy()
+    out[rows[same], cols[same]] = kept["text"].to_numpy()
+    return out, kept
+
 def read_sheet(sheet_id: str = GOOGLE_SHEET_ID, tab: str = SHEET_TAB_NAME) -> pd.DataFrame:
-    gc = get_gsheet_client()
-    sh = gc.open_by_key(sheet_id)
-    ws = sh.worksheet(tab)
-    data = ws.get_all_records()
-    return pd.DataFrame(data)
-
-def write_sheet(df: pd.DataFrame, sheet_id: str = GOOGLE_SHEET_ID, tab: str = SHEET_TAB_NAME):
-    gc = get_gsheet_client()
-    sh = gc.open_by_key(sheet_id)
     try:
-        ws = sh.worksheet(tab)
+        values = sheets_call(get_worksheet(sheet_id, tab).get_all_values)
+    except Exception:
+        forget_worksheet(sheet_id, tab)
+        raise
+    if not values:
+        get_synced_frames().pop((sheet_id, tab), None)
+        return pd.DataFrame()
+
+    header, rows = values[0], values[1:]
+    texts = np.array(rows, dtype=object).reshape(len(rows), len(header))
+    get_synced_frames()[(sheet_id, tab)] = (header, texts)
+    get_sheet_texts()[(sheet_id, tab)] = (header, texts, None)
+    # Same numeric conversion get_all_records() applies
+    rows = [gspread.utils.numericise_all(row) for row in rows]
+    return pd.DataFrame(rows, columns=header)
+
+def write_sheet(df: pd.DataFrame, sheet_id: str = GOOGLE_SHEET_ID, tab: str = SHEET_TAB_NAME, full: bool = False):
+    """
+    Push df to the worksheet.
+    By default only the cells that differ from the last synced values are sent,
+    as one batch_update, after deleting the sheet rows whose S.NO is gone. A
+    full clear + rewrite happens when full=True, when the columns changed, or
+    when nothing has been synced yet.
+    """
+    try:
+        ws = get_worksheet(sheet_id, tab)
     except gspread.exceptions.WorksheetNotFound:
-        ws = sh.add_worksheet(title=tab, rows="5000", cols="30")
+        ws = sheets_call(
+            get_spreadsheet(sheet_id).add_worksheet, title=tab, rows="5000", cols="30", idempotent=False,
+        )
+        get_sheet_handles()[(sheet_id, tab)] = ws
+        full = True
+
+    synced = get_synced_frames()
+    header = [str(c) for c in df.columns]
+    body = to_sheet_frame(df).to_numpy(dtype=object).reshape(len(df), len(header))
+    body, kept = keep_sheet_text(header, body, (sheet_id, tab))
+    previous = synced.get((sheet_id, tab))
+
+    if full or previous is None or previous[0] != header:
+        sheets_call(ws.clear)
+        if header:
+            sheets_call(ws.update, [header] + body.tolist())
+        synced[(sheet_id, tab)] = (header, body)
+        get_sheet_texts()[(sheet_id, tab)] = (header, None, kept)
+        return
 
-    ws.clear()
+    prev_body = previous[1]
+    n_old, n_new = len(prev_body), len(body)
+
+    if n_new < n_old and "S.NO" in header:
+        # Rows deleted by S.NO are removed from the sheet, not shifted up cell by cell
+        k = header.index("S.NO")
+        gone = np.flatnonzero(~np.isin(prev_body[:, k], body[:, k]))
+        if len(gone) == n_old - n_new:
+            sheets_call(get_spreadsheet(sheet_id).batch_update, {"requests": [
+                {"deleteDimension": {"range": {
+                    "sheetId": ws.id, "dimension": "ROWS",
+                    "startIndex": r + 1, "endIndex": r + 2,
+                }}}
+                for r in gone[::-1].tolist()  # bottom-up keeps indexes valid
+            ]}, idempotent=False)
+            # The cached handle still has the old row count
+            forget_worksheet(sheet_id, tab)
+            prev_body = np.delete(prev_body, gone, axis=0)
+            n_old = n_new
+
+    common = min(n_old, n_new)
+
+    updates = []
+    if common:
+        rows, cols = np.nonzero(body[:common] != prev_body[:common])
+        for r, c in zip(rows.tolist(), cols.tolist()):
+            updates.append({
+                "range": gspread.utils.rowcol_to_a1(r + 2, c + 1),
+                "values": [[body[r, c]]],
+            })
+
+    if n_new > n_old and not updates:
+        # Rows only added at the end: one append call, which also grows the grid
+        sheets_call(ws.append_rows, body[n_old:].tolist(), table_range="A1", idempotent=False)
+    elif n_new > n_old:
+        # Row 1 is the header, so data row i lives on sheet row i + 2
+        if ws.row_count < n_new + 1:
+            sheets_call(ws.add_rows, n_new + 1 - ws.row_count, idempotent=False)
+        updates.append({
+            "range": gspread.utils.rowcol_to_a1(n_old + 2, 1),
+            "values": body[n_old:].tolist(),
+        })
+
+    if updates:
+        sheets_call(ws.batch_update, updates)
+
+    if n_new < n_old:
+        sheets_call(ws.batch_clear, [
+            f"{gspread.utils.rowcol_to_a1(n_new + 2, 1)}:"
+            f"{gspread.utils.rowcol_to_a1(n_old + 1, len(header))}"
+        ])
 
-    if df.empty:
-        # Just write headers if any
-        if len(df.columns) > 0:
-            ws.update([df.columns.tolist()])
+    synced[(sheet_id, tab)] = (header, body)
+    get_sheet_texts()[(sheet_id, tab)] = (header, None, kept)
+
+
+SHEET_WRITE_DEBOUNCE_SECONDS = 1.5  # quiet period before pending edits are flushed
+SHEET_WRITE_RETRY_SECONDS = 10      # wait before retrying a failed flush
+
+class SheetWriteBehind:
+    """
+    Background writer for Google Sheets.
+    Writes are coalesced per worksheet (latest frame wins) and flushed by a
+    daemon thread once no new write arrived for the debounce period, so
+    Streamlit reruns never wait on the network.
+    """
+
+    def __init__(self, debounce: float = SHEET_WRITE_DEBOUNCE_SECONDS):
+        self.debounce = debounce
+        self.status = "synced"  # "pending" | "synced" | "failed"
+        self.error = None
+        self.last_synced_at = None
+        self._pending = {}      # (sheet_id, tab) -> (df, full, queued_at)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="sheet-write-behind", daemon=True).start()
+        atexit.register(self.flush)
+
+    def submit(self, df: pd.DataFrame, sheet_id: str, tab: str, full: bool = False):
+        with self._lock:
+            previous = self._pending.get((sheet_id, tab))
+            # A pending full rewrite must not be downgraded to a diff
+            full = full or (previous is not None and previous[1])
+            self._pending[(sheet_id, tab)] = (df, full, time.monotonic())
+            self.status = "pending"
+        self._wake.set()
+
+    def flush(self):
+        """Write everything that is pending right now."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._wake.clear()
+
+        failed = None
+        for (sheet_id, tab), (df, full, queued_at) in batch.items():
+            try:
+                write_sheet(df, sheet_id, tab, full=full)
+                if (sheet_id, tab) == (GOOGLE_SHEET_ID, SHEET_TAB_NAME):
+                    save_master_cache(df)
+            except Exception as e:
+                failed = e
+                forget_worksheet(sheet_id, tab)
+                # Some calls may have gone through, so the sheet no longer
+                # matches the synced baseline: the retry rewrites it in full
+                get_synced_frames().pop((sheet_id, tab), None)
+                with self._lock:
+                    # Keep the failed frame unless a newer one arrived meanwhile
+                    self._pending.setdefault((sheet_id, tab), (df, full, queued_at))
+
+        with self._lock:
+            if failed is not None:
+                self.status, self.error = "failed", failed
+            elif not self._pending:
+                self.status, self.error = "synced", None
+                self.last_synced_at = datetime.now()
+
+    def _run(self):
+        while True:
+            timeout = SHEET_WRITE_RETRY_SECONDS if self.status == "failed" else None
+            self._wake.wait(timeout)
+            # Debounce: wait until the newest pending write has been quiet long enough
+            while True:
+                with self._lock:
+                    newest = max((q for _, _, q in self._pending.values()), default=None)
+                if newest is None:
+                    break
+                delay = newest + self.debounce - time.monotonic()
+                if delay <= 0:
+                    break
+                time.sleep(delay)
+            self.flush()
+
+@st.cache_resource
+def get_sheet_writer() -> SheetWriteBehind:
+    return SheetWriteBehind()
+
+def queue_sheet_write(df: pd.DataFrame, sheet_id: str = GOOGLE_SHEET_ID, tab: str = SHEET_TAB_NAME, full: bool = False):
+    """Hand df to the background writer; returns immediately."""
+    get_sheet_writer().submit(df, sheet_id, tab, full=full)
+
+MERGE_NOTICE_SECONDS = 20  # how long a conflict notice stays up
+
+def report_conflicts(conflicts: list[tuple]):
+    """
+    Tell this session which of its writes lost to newer edits from someone
+    else: (S.NO, column, value not written, value kept) tuples, column None
+    for a row that was kept instead of deleted. Shown by render_sync_status.
+    """
+    if not conflicts:
         return
 
-    values = [df.columns.tolist()] + df.astype(str).values.tolist()
-    ws.update(values)
+    def shown(value) -> str:
+        return "blank" if pd.isna(value) or value == "" else f"'{value}'"
+
+    lines = [
+        f"#{sno}: not deleted, it was changed meanwhile" if col is None
+        else f"#{sno} {col}: kept {shown(current)} instead of your {shown(mine)}"
+        for sno, col, mine, current in conflicts[:5]
+    ]
+    if len(conflicts) > 5:
+        lines.append(f"…and {len(conflicts) - 5} more")
+    st.session_state.setdefault("merge_notices", []).append((
+        time.monotonic(),
+        "Someone else changed these first, so your change was not applied:\n"
+        + "\n".join(f"- {line}" for line in lines),
+    ))
+
+def duplicate_lines(report: pd.DataFrame, limit: int = 5) -> list[str]:
+    """'COLUMN value: #S.NO name, …' per shared value of a duplicate_report()."""
+    groups = list(report.groupby(["Column", "Value"], sort=False))
+    lines = [
+        f"{col} {value}: " + ", ".join(f"#{sno} {name}" for sno, name in zip(rows["S.NO"], rows["MASON NAME"]))
+        for (col, value), rows in groups[:limit]
+    ]
+    if len(groups) > limit:
+        lines.append(f"…and {len(groups) - limit} more")
+    return lines
+
+def report_duplicates(snos) -> pd.DataFrame:
+    """
+    Flag to this session the rows among `snos` that share a MASON CODE or
+    CONTACT NUMBER with another row (shown by render_sync_status, like
+    conflicts). Returns the store's duplicate_report for them.
+    """
+    report = store.duplicate_report(snos)
+    if len(report):
+        st.session_state.setdefault("merge_notices", []).append((
+            time.monotonic(),
+            "These masons share a MASON CODE or CONTACT NUMBER with another row:\n"
+            + "\n".join(f"- {line}" for line in duplicate_lines(report)),
+        ))
+    return report
+
+@st.fragment(run_every=2)
+def render_sync_status():
+    writer = get_sheet_writer()
+    if writer.status == "pending":
+        st.caption("🟡 Saving changes to Google Sheets…")
+    elif writer.status == "failed":
+        st.caption(f"🔴 Sync failed, retrying: {writer.error}")
+    elif writer.last_synced_at is not None:
+        st.caption(f"🟢 All changes synced ({writer.last_synced_at.strftime('%H:%M:%S')})")
+    else:
+        st.caption("🟢 Synced with Google Sheets")
+
+    notices = [
+        (at, text) for at, text in st.session_state.get("merge_notices", [])
+        if time.monotonic() - at < MERGE_NOTICE_SECONDS
+    ]
+    st.session_state["merge_notices"] = notices
+    for _, text in notices:
+        st.warning(text, icon="⚠️")
+
+    limiter = get_sheets_limiter()
+    if limiter.calls:
+        st.caption(
+            f"Sheets API: {limiter.calls:,} calls · {limiter.throttled:,} throttled"
+            f" · {limiter.retried:,} retried"
+        )
+
+    seen = st.session_state.get("data_version")
+    if seen is not None and get_dataset_store().version != seen:
+        if st.button("🔄 Newer data available – refresh", key="btn_refresh_shared"):
+            st.rerun(scope="app")
 
 
 # ------------ CONFIG ------------
@@ -205,14 +613,200 @@ st.markdown('<script src="https://cdn.tailwindcss.com"></script>', unsafe_allow_
 
 # ------------ HELPERS ------------
 
+# ------------ SCHEMA ------------
+# In memory the master is typed; strings ("YES", "Visited", "2024-05-01")
+# only exist at the Google Sheets / Excel boundary (see to_sheet_frame).
+
+HW_COLUMNS = ["HW305", "HW101", "Hw201", "HW103", "HW302", "HW310"]   # bool
+CATEGORY_COLUMNS = ["DAY", "Location", "DLR NAME", "Category"]          # category
+STATUS_LABELS = {"Visited_Status": "Visited", "Registered_Status": "Registered"}  # bool
+DATE_COLUMNS = ["Visited_At", "Registered_At"]                          # datetime64
+UNIQUE_COLUMNS = ["MASON CODE", "CONTACT NUMBER"]                      # one mason per value
+SHEET_DATE_FORMAT = "%Y-%m-%d"
+
+def _per_unique(s: pd.Series, func) -> pd.Series:
+    """
+    Apply a vectorized Series -> Series func to the distinct values of s only
+    and broadcast the result back by position. String ops on object columns
+    run in Python per element, and most master columns repeat a few values.
+    Values are told apart by type as well (5, 5.0 and True are not merged),
+    and func sees each kind of missing value (None, NaN, NaT) as itself.
+    """
+    codes, uniques = pd.factorize(s)
+    if len(uniques) > len(s) // 2:
+        # Mostly distinct (names, codes): deduplicating would not save any calls
+        return pd.Series(func(s.astype(object).reset_index(drop=True)).to_numpy(), index=s.index)
+    missing = codes == -1
+    if s.dtype == object and pd.api.types.infer_dtype(uniques, skipna=True) not in ("string", "empty"):
+        # Mixed cells: factorize treats equal values of different types as one
+        kinds = pd.factorize(s.map(type))[0]
+    elif missing.any():
+        # factorize codes every missing value as -1, whatever its kind
+        kinds = np.zeros(len(s), dtype=np.intp)
+        kinds[missing] = pd.factorize(s[missing].map(type))[0]
+    else:
+        values = np.asarray(uniques, dtype=object)
+        return pd.Series(func(pd.Series(values, dtype=object)).to_numpy().take(codes), index=s.index)
+
+    codes = pd.factorize(kinds.astype(np.int64) * (len(uniques) + 1) + codes + 1)[0]
+    # Codes are numbered in order of first appearance
+    first = pd.Series(codes).drop_duplicates().index.to_numpy()
+    values = s.to_numpy(dtype=object)[first]
+    return pd.Series(func(pd.Series(values, dtype=object)).to_numpy().take(codes), index=s.index)
+
+def _as_text(s: pd.Series) -> pd.Series:
+    return _per_unique(s, lambda u: u.where(u.notna(), "").astype(str))
+
+def _as_flag(s: pd.Series, label: str, exact: bool) -> pd.Series:
+    if s.dtype == bool:
+        return s
+
+    def flag(u: pd.Series) -> pd.Series:
+        text = u.where(u.notna(), "").astype(str).str.upper()
+        hit = text.eq(label.upper()) if exact else text.str.contains(label.upper(), regex=False)
+        return hit | text.eq("TRUE")
+
+    return _per_unique(s, flag).astype(bool)
+
+def normalize_contact(s: pd.Series) -> pd.Series:
+    """Digits-only phone numbers as Int64 (<NA> when missing or not a number)."""
+    # Fast path: cells that already are whole non-negative numbers
+    numbers = pd.to_numeric(s, errors="coerce")
+    is_number = numbers.notna() & (numbers >= 0) & (numbers < 1e15) & (numbers % 1 == 0)
+    out = numbers.where(is_number).astype("Int64")
+
+    rest = s[~is_number & s.notna()]
+    if not rest.empty:
+        digits = _per_unique(rest, lambda u: (
+            u.where(u.notna(), "").astype(str)
+            .str.replace(r"\.0$", "", regex=True)
+            .str.replace(r"\D", "", regex=True)
+        ))
+        # Longer than 15 digits is not a phone number and would not survive float parsing
+        digits = digits.where(digits.str.len().between(1, 15))
+        # Assigned as an array: pandas can't set an Int64 Series into one by labels
+        out[rest.index] = pd.to_numeric(digits, errors="coerce").astype("Int64").array
+    return out
+
+def format_contact(value) -> str:
+    return "" if pd.isna(value) else str(int(value))
+
+def _strip_strings(df: pd.DataFrame) -> pd.DataFrame:
+    """Strip surrounding whitespace from every str cell, one text column at a time."""
+    def strip(u: pd.Series) -> pd.Series:
+        kind = pd.api.types.infer_dtype(u, skipna=True)
+        if kind == "string":
+            # All str: trim in Arrow instead of one Python call per value
+            return u.astype("string[pyarrow]").str.strip().astype(object).where(u.notna(), u)
+        if kind not in ("mixed", "mixed-integer"):
+            return u  # no str cells at all
+        # .str is slow on mixed cells; numbers and dates are kept as they were
+        return pd.Series([x.strip() if isinstance(x, str) else x for x in u], index=u.index, dtype=object)
+
+    df = df.copy()
+    for col in df.select_dtypes(include=["object", "string"]).columns:
+        df[col] = _per_unique(df[col], strip)
+    return df
+
 def clean_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """Strip whitespace and convert columns to the master schema dtypes."""
     df.columns = [str(c).strip() for c in df.columns]
-    df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
-    df = df.fillna("")
-    if "S.NO" in df.columns:
-        df["S.NO"] = pd.to_numeric(df["S.NO"], errors="coerce").fillna(0).astype(int)
+    df = _strip_strings(df)
+
+    # Status columns may be missing from older files
+    for col in STATUS_LABELS:
+        if col not in df.columns:
+            df[col] = False
+    for col in DATE_COLUMNS:
+        if col not in df.columns:
+            df[col] = pd.NaT
+
+    for col in df.columns:
+        if col == "S.NO":
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype(int)
+        elif col in HW_COLUMNS:
+            df[col] = _as_flag(df[col], "YES", exact=False)
+        elif col in STATUS_LABELS:
+            df[col] = _as_flag(df[col], STATUS_LABELS[col], exact=True)
+        elif col in DATE_COLUMNS:
+            if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = pd.to_datetime(_as_text(df[col]), errors="coerce", format="mixed")
+        elif col in CATEGORY_COLUMNS:
+            df[col] = _as_text(df[col]).astype("category")
+        elif col == "CONTACT NUMBER":
+            df[col] = normalize_contact(df[col])
+        else:
+            df[col] = _as_text(df[col])
     return df
 
+def to_sheet_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Render the typed master as the plain strings stored in Sheets / Excel."""
+    out = {}
+    for col in df.columns:
+        s = df[col]
+        if col in HW_COLUMNS:
+            out[col] = np.where(s.astype(bool), "YES", "")
+        elif col in STATUS_LABELS:
+            out[col] = np.where(s.astype(bool), STATUS_LABELS[col], "")
+        elif col in DATE_COLUMNS:
+            out[col] = pd.to_datetime(s, errors="coerce").dt.strftime(SHEET_DATE_FORMAT).fillna("")
+        else:
+            out[col] = _as_text(s)
+    return pd.DataFrame(out, index=df.index, columns=df.columns)
+
+def coerce_cell(column: str, value):
+    """Convert a single widget value to the dtype of `column`."""
+    if column in HW_COLUMNS or column in STATUS_LABELS:
+        return bool(value)
+    if column in DATE_COLUMNS:
+        return pd.to_datetime(value, errors="coerce") if value not in (None, "") else pd.NaT
+    if column == "CONTACT NUMBER":
+        return normalize_contact(pd.Series([value])).iloc[0]
+    if column == "S.NO":
+        return int(value)
+    return "" if value is None else str(value).strip()
+
+def unique_key(column: str, value):
+    """
+    The normalized form of a UNIQUE_COLUMNS value that duplicates are
+    matched on (codes ignore case and surrounding spaces, contacts keep
+    digits only), or None for a blank value, which is never a duplicate.
+    """
+    if column == "CONTACT NUMBER" and isinstance(value, str) and value.strip().isdigit():
+        # Plain digit strings skip the Series round trip in normalize_contact
+        value = value.strip()
+        return int(value) if len(value) <= 15 else None
+    value = coerce_cell(column, value)
+    if pd.isna(value) or value == "":
+        return None
+    return int(value) if column == "CONTACT NUMBER" else value.upper()
+
+def unique_keys(column: str, s: pd.Series) -> pd.Series:
+    """unique_key() of a cleaned master column, with <NA> for blank values."""
+    if column == "CONTACT NUMBER":
+        return normalize_contact(s)
+    keys = _per_unique(s, lambda u: _as_text(u).str.upper())
+    return keys.where(keys.ne(""), pd.NA)
+
+def _same_value(a, b) -> bool:
+    """Cell equality where all missing values (None/NaN/NA/NaT) are equal."""
+    a_na, b_na = pd.isna(a), pd.isna(b)
+    if a_na or b_na:
+        return a_na and b_na
+    return bool(a == b)
+
+def _column_changes(before: pd.DataFrame, after: pd.DataFrame):
+    """
+    For two frames with the same rows and columns, yield (column, changed
+    positions, old values, new values), compared as whole arrays.
+    """
+    for col in before.columns:
+        # Missing values of any kind compare as None
+        a = before[col].astype(object).where(before[col].notna(), None).to_numpy()
+        b = after[col].astype(object).where(after[col].notna(), None).to_numpy()
+        changed = np.flatnonzero(a != b)
+        yield col, changed, a[changed], b[changed]
+
 def get_template_excel() -> bytes:
     columns = [
         "S.NO", "MASON CODE", "MASON NAME", "CONTACT NUMBER",
@@ -226,37 +820,385 @@ def get_template_excel() -> bytes:
         df_template.to_excel(writer, index=False, sheet_name="Template")
     return output.getvalue()
 
-def load_excel_data(uploaded_file) -> pd.DataFrame | None:
+# Rows validated and cleaned at a time while streaming an import
+IMPORT_CHUNK_ROWS = 5000
+
+def iter_excel_chunks(uploaded_file, chunk_rows: int = IMPORT_CHUNK_ROWS):
+    """
+    Stream the first worksheet of an upload as (rows read, total rows or
+    None, raw chunk) tuples, each chunk a DataFrame of up to chunk_rows
+    non-blank rows under the header. .xlsx is read through openpyxl's
+    read-only mode, one row at a time; legacy .xls has no streaming reader
+    and is loaded whole, then handed out the same way.
+    """
+    if getattr(uploaded_file, "name", "").lower().endswith(".xls"):
+        df = pd.read_excel(uploaded_file, dtype=object)
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows].dropna(how="all")
+            yield min(start + chunk_rows, len(df)), len(df), chunk.reset_index(drop=True)
+        return
+
+    wb = load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        # Columns without a header cell are dropped
+        keep = [i for i, name in enumerate(header) if name is not None]
+        columns = [str(header[i]).strip() for i in keep]
+        total = ws.max_row - 1 if ws.max_row else None
+
+        buffer, read = [], 0
+        for values in rows:
+            read += 1
+            row = [values[i] if i < len(values) else None for i in keep]
+            if any(v is not None and v != "" for v in row):
+                buffer.append(row)
+            if len(buffer) == chunk_rows:
+                yield read, total, pd.DataFrame(buffer, columns=columns, dtype=object)
+                buffer = []
+        if buffer:
+            yield read, total, pd.DataFrame(buffer, columns=columns, dtype=object)
+    finally:
+        wb.close()
+
+def load_excel_data(uploaded_file, key_column: str | None = None) -> pd.DataFrame | None:
+    """
+    Read an upload chunk by chunk with a progress bar, cleaning each chunk
+    into the master schema. Problems that stop the import are shown as
+    errors (returns None); the rest are kept in session state under
+    "import_notes" for the import tab to show. key_column, when given, must
+    be present (upsert imports match rows on it), and blank cells and
+    contact numbers that are not valid numbers are left missing rather than
+    filled with defaults, so the update keeps the existing values there.
+    """
+    progress = st.progress(0.0, text="Reading file…")
+    chunks, read, bad_contacts = [], 0, 0
     try:
-        df = pd.read_excel(uploaded_file)
-        return clean_dataframe(df)
+        for read, total, raw in iter_excel_chunks(uploaded_file):
+            if not chunks:
+                duplicated = raw.columns[raw.columns.duplicated()].tolist()
+                if duplicated:
+                    raise ValueError(f"duplicate column headers: {', '.join(duplicated)}")
+                if key_column and key_column not in raw.columns:
+                    raise ValueError(f"the file has no '{key_column}' column")
+            chunk = clean_dataframe(raw.copy())
+            if "CONTACT NUMBER" in raw.columns:
+                given = _as_text(raw["CONTACT NUMBER"]).str.strip().ne("")
+                bad_contacts += int((given & chunk["CONTACT NUMBER"].isna()).sum())
+            if key_column:
+                # clean_dataframe keeps the raw columns first, in order
+                for raw_col, col in zip(raw.columns, chunk.columns):
+                    if col not in ("S.NO", key_column):
+                        blank = _as_text(raw[raw_col]).str.strip().eq("")
+                        if blank.any():
+                            chunk[col] = chunk[col].mask(blank)
+            chunks.append(chunk)
+            progress.progress(min(read / total, 1.0) if total else 0.0,
+                              text=f"Read {read:,} rows…")
     except Exception as e:
+        progress.empty()
         st.error(f"Error loading file: {e}")
         return None
+    progress.empty()
+
+    df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+    if df.empty:
+        st.error("Error loading file: no data rows found.")
+        return None
+    # Chunks carry their own categories; concat leaves those columns as object
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(object).astype("category")
+
+    notes = []
+    if read > len(df):
+        notes.append(f"Skipped {read - len(df):,} blank rows.")
+    if bad_contacts and key_column:
+        notes.append(f"{bad_contacts:,} contact numbers were not valid numbers; existing masons keep "
+                     "their current number and new ones are left blank.")
+    elif bad_contacts:
+        notes.append(f"{bad_contacts:,} contact numbers were not valid numbers and were left blank.")
+    if key_column:
+        keys = unique_keys(key_column, df[key_column])
+        missing = int(keys.isna().sum())
+        repeated = int(keys.dropna().duplicated().sum())
+        if missing:
+            notes.append(f"{missing:,} rows have no {key_column} and are added as new masons.")
+        if repeated:
+            notes.append(f"{repeated:,} rows repeat a {key_column} from earlier in the file; the last one is used.")
+    st.session_state["import_notes"] = notes
+    return df
 
-def save_state_for_undo():
-    st.session_state["prev_data"] = st.session_state["data"].copy()
+# Rows rendered to sheet strings at a time while streaming an export
+EXPORT_CHUNK_ROWS = 5000
 
 def to_excel(df: pd.DataFrame) -> bytes:
+    """
+    Write df as xlsx through a write-only (streaming) workbook. Rows are
+    rendered and appended a chunk at a time, so memory use does not grow
+    with the row count beyond the finished file itself.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("MasonData")
+    ws.append(list(df.columns))
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        chunk = to_sheet_frame(df.iloc[start:start + EXPORT_CHUNK_ROWS])
+        for values in chunk.itertuples(index=False, name=None):
+            ws.append([v if v != "" else None for v in values])
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="MasonData")
+    wb.save(output)
     return output.getvalue()
 
+@st.cache_resource(max_entries=2, show_spinner=False)
+def export_excel(version: int, _df: pd.DataFrame) -> bytes:
+    """to_excel() of the master at this dataset version, built once and shared."""
+    return to_excel(_df)
+
+def current_export() -> bytes:
+    """Download-button callback: the xlsx export of the current master."""
+    return export_excel(*store.snapshot())
+
 DATA_FILE = "mason_data.xlsx"
 SNAPSHOT_DIR = Path("mason_snapshots")
 SNAPSHOT_DIR.mkdir(exist_ok=True)
+SNAPSHOT_MANIFEST = SNAPSHOT_DIR / "manifest.json"
+SNAPSHOT_FULL_EVERY = 12        # longest chain of deltas before a full snapshot
+SNAPSHOT_DELTA_MAX_SHARE = 0.5  # store in full when more rows than this changed
+SNAPSHOT_LOCK = threading.Lock()
+
+# Local copy of the last-known master, used to render instantly on startup
+CACHE_DIR = Path("mason_cache")
+MASTER_CACHE_FILE = CACHE_DIR / "master.parquet"
+
+def save_master_cache(df: pd.DataFrame):
+    CACHE_DIR.mkdir(exist_ok=True)
+    # Unique temp name so concurrent writers never clobber each other mid-write
+    tmp_path = MASTER_CACHE_FILE.with_suffix(f".{threading.get_ident()}.tmp")
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, MASTER_CACHE_FILE)
+
+def load_master_cache() -> pd.DataFrame | None:
+    if not MASTER_CACHE_FILE.exists():
+        return None
+    try:
+        return clean_dataframe(pd.read_parquet(MASTER_CACHE_FILE))
+    except Exception:
+        return None
+
+# Monthly snapshots are zstd Parquet files listed in manifest.json as
+# {"YYYY-MM": {"file", "base", "depth", "rows", "saved_at"}}. A month with a
+# base stores only the rows that differ from the base month, plus S.NO
+# tombstones (_deleted) for rows that are gone.
+
+def load_snapshot_manifest() -> dict:
+    """The snapshot index, {month_key: entry}; migrates old .xlsx snapshots once."""
+    with SNAPSHOT_LOCK:
+        if not SNAPSHOT_MANIFEST.exists():
+            _write_snapshot_manifest({})
+            legacy = sorted(SNAPSHOT_DIR.glob("mason_data_*.xlsx"))
+        else:
+            legacy = []
+    for path in legacy:
+        month_key = path.stem.replace("mason_data_", "")
+        save_month_snapshot(clean_dataframe(pd.read_excel(path)), month_key)
+    return json.loads(SNAPSHOT_MANIFEST.read_text())
+
+def _write_snapshot_manifest(manifest: dict):
+    tmp_path = SNAPSHOT_MANIFEST.with_suffix(f".{threading.get_ident()}.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(tmp_path, SNAPSHOT_MANIFEST)
+
+def _read_snapshot_file(entry: dict, columns: list[str] | None = None) -> pd.DataFrame:
+    """One stored snapshot file, memory-mapped, optionally just some columns."""
+    path = SNAPSHOT_DIR / entry["file"]
+    if columns is not None:
+        present = set(pq.read_schema(path).names)
+        columns = [c for c in columns + ["_deleted"] if c in present]
+    return pd.read_parquet(path, columns=columns, memory_map=True)
+
+def _apply_snapshot_delta(base: pd.DataFrame, stored: pd.DataFrame) -> pd.DataFrame:
+    """The month stored as a delta in `stored`, rebuilt on top of its base frame."""
+    deleted = stored["_deleted"].astype(bool)
+    rows = stored[~deleted].drop(columns="_deleted")
+    kept = base[~base["S.NO"].isin(stored.loc[deleted, "S.NO"])]
+
+    # Changed rows take the place of their old version, new rows go last
+    replaced = kept["S.NO"].isin(rows["S.NO"])
+    slot_of = pd.Series(np.arange(len(kept)), index=kept["S.NO"].to_numpy())
+    slot_of = slot_of[~slot_of.index.duplicated(keep="last")]
+    slots = rows["S.NO"].map(slot_of).fillna(len(kept)).to_numpy()
+    keys = np.concatenate([np.arange(len(kept))[~replaced.to_numpy()], slots])
+    combined = pd.concat([kept[~replaced], rows], ignore_index=True)
+    combined = combined.iloc[np.argsort(keys, kind="stable")].reset_index(drop=True)
+    return clean_dataframe(combined)
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _snapshot_frame(month_key: str, manifest: dict) -> pd.DataFrame:
+    """A month's full frame, rebuilt from its chain of deltas. Shared, read-only."""
+    entry = manifest[month_key]
+    stored = _read_snapshot_file(entry)
+    if entry["base"] is None:
+        return clean_dataframe(stored)
+    return _apply_snapshot_delta(_snapshot_frame(entry["base"], manifest), stored)
+
+def load_month_snapshot(month_key: str, manifest: dict | None = None) -> pd.DataFrame:
+    manifest = load_snapshot_manifest() if manifest is None else manifest
+    return _snapshot_frame(month_key, manifest)
+
+def _snapshot_delta(base: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame | None:
+    """Rows of df that are new or differ from base, plus tombstones; None if not worth it."""
+    if list(base.columns) != list(df.columns) or "S.NO" not in df.columns:
+        return None
+    base = base.drop_duplicates("S.NO", keep="last").set_index("S.NO")
+    cur = df.drop_duplicates("S.NO", keep="last").set_index("S.NO")
+    common = cur.index.intersection(base.index)
+
+    changed = np.zeros(len(common), dtype=bool)
+    for _, positions, _, _ in _column_changes(base.loc[common], cur.loc[common]):
+        changed[positions] = True
+    dirty = common[changed].union(cur.index.difference(base.index))
+    gone = base.index.difference(cur.index)
+    if len(dirty) + len(gone) > SNAPSHOT_DELTA_MAX_SHARE * max(len(df), 1):
+        return None
+
+    rows = df[df["S.NO"].isin(dirty)].assign(_deleted=False)
+    tombstones = pd.DataFrame({"S.NO": gone.to_numpy(), "_deleted": True})
+    return pd.concat([rows, tombstones], ignore_index=True)
 
-def save_month_snapshot(df: pd.DataFrame, month_key: str | None = None) -> Path:
+def save_month_snapshot(df: pd.DataFrame, month_key: str | None = None) -> str:
     """
-    Save current data as a month-wise snapshot file and return its path.
-    month_key format: 'YYYY-MM'. If None, use current month.
+    Save current data as the snapshot for month_key ('YYYY-MM', default: this
+    month) and return the key. Stored as a delta against the previous month's
+    snapshot unless the chain is long or most rows changed.
     """
     if month_key is None:
         month_key = datetime.now().strftime("%Y-%m")
-    file_path = SNAPSHOT_DIR / f"mason_data_{month_key}.xlsx"
-    df.to_excel(file_path, index=False)
-    return file_path
+    load_snapshot_manifest()
+
+    with SNAPSHOT_LOCK:
+        manifest = json.loads(SNAPSHOT_MANIFEST.read_text())
+        # Months built on the one being replaced become full snapshots first
+        for later, entry in list(manifest.items()):
+            if entry["base"] == month_key:
+                full = load_month_snapshot(later, manifest)
+                manifest[later] = _store_snapshot(later, full, None, 0)
+
+        earlier = sorted(k for k in manifest if k < month_key)
+        delta = None
+        if earlier and manifest[earlier[-1]]["depth"] < SNAPSHOT_FULL_EVERY - 1:
+            base_key = earlier[-1]
+            delta = _snapshot_delta(load_month_snapshot(base_key, manifest), df)
+        if delta is None:
+            manifest[month_key] = _store_snapshot(month_key, df, None, 0)
+        else:
+            manifest[month_key] = _store_snapshot(
+                month_key, delta, base_key, manifest[base_key]["depth"] + 1, rows=len(df)
+            )
+        # Chains that ran through a month made full above are shorter now
+        for key in sorted(manifest):
+            base = manifest[key]["base"]
+            manifest[key]["depth"] = 0 if base is None else manifest[base]["depth"] + 1
+        rate_aggregates(df).to_parquet(_aggregates_path(month_key), index=False)
+        _write_snapshot_manifest(manifest)
+    return month_key
+
+def _store_snapshot(month_key: str, frame: pd.DataFrame, base: str | None, depth: int,
+                    rows: int | None = None) -> dict:
+    """Write one snapshot file and return its manifest entry."""
+    kind = "full" if base is None else "delta"
+    file_name = f"{month_key}.{kind}.parquet"
+    for stale in (SNAPSHOT_DIR / f"{month_key}.{k}.parquet" for k in ("full", "delta")):
+        stale.unlink(missing_ok=True)
+    frame.to_parquet(SNAPSHOT_DIR / file_name, index=False, compression="zstd")
+    return {
+        "file": file_name,
+        "base": base,
+        "depth": depth,
+        "rows": len(frame) if rows is None else rows,
+        "saved_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def snapshot_excel(month_key: str, saved_at: str) -> bytes:
+    """A month's snapshot as xlsx, built when it is first downloaded."""
+    return to_excel(load_month_snapshot(month_key))
+
+# ------------ TRENDS ACROSS SNAPSHOTS ------------
+
+TREND_COLUMNS = ["S.NO", "Location", "DLR NAME", *HW_COLUMNS, "Visited_Status", "Registered_Status"]
+
+def _aggregates_path(month_key: str) -> Path:
+    return SNAPSHOT_DIR / f"{month_key}.agg.parquet"
+
+def rate_aggregates(df: pd.DataFrame) -> pd.DataFrame:
+    """Masons, visited and registered counts per Location, DLR and product."""
+    visited = df["Visited_Status"].to_numpy(dtype=bool)
+    registered = df["Registered_Status"].to_numpy(dtype=bool)
+
+    parts = []
+    for dim in ("Location", "DLR NAME"):
+        if dim in df.columns:
+            counts = pd.DataFrame({
+                "value": _as_text(df[dim]).replace("", "Blank").to_numpy(),
+                "masons": 1, "visited": visited, "registered": registered,
+            }).groupby("value", sort=False).sum()
+            parts.append(counts.reset_index().assign(dimension=dim))
+
+    products = [c for c in HW_COLUMNS if c in df.columns]
+    flags = df[products].to_numpy(dtype=bool)
+    parts.append(pd.DataFrame({
+        "dimension": "Product",
+        "value": products,
+        "masons": flags.sum(axis=0),
+        "visited": (flags & visited[:, None]).sum(axis=0),
+        "registered": (flags & registered[:, None]).sum(axis=0),
+    }))
+    return pd.concat(parts, ignore_index=True)[["dimension", "value", "masons", "visited", "registered"]]
+
+@st.cache_resource(max_entries=128, show_spinner=False)
+def month_aggregates(month_key: str, saved_at: str, _frame) -> pd.DataFrame:
+    """
+    rate_aggregates() of one snapshot, as saved next to it. `_frame()`
+    rebuilds the snapshot if that file is missing.
+    """
+    path = _aggregates_path(month_key)
+    if path.exists():
+        return pd.read_parquet(path, memory_map=True)
+    return rate_aggregates(_frame())
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def live_aggregates(version: int, _df: pd.DataFrame) -> pd.DataFrame:
+    return rate_aggregates(_df)
+
+def snapshot_trends(manifest: dict, version: int, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    rate_aggregates() for every snapshot month plus the live data, in long
+    format with a `month` column. Months whose aggregates are neither cached
+    nor on disk are rebuilt, reading just TREND_COLUMNS from each file.
+    """
+    rebuilt = {}
+
+    def frame_of(month_key: str) -> pd.DataFrame:
+        if month_key not in rebuilt:
+            entry = manifest[month_key]
+            stored = _read_snapshot_file(entry, TREND_COLUMNS)
+            rebuilt[month_key] = (
+                clean_dataframe(stored) if entry["base"] is None
+                else _apply_snapshot_delta(frame_of(entry["base"]), stored)
+            )
+        return rebuilt[month_key]
+
+    parts = [
+        month_aggregates(m, manifest[m]["saved_at"], lambda m=m: frame_of(m)).assign(month=m)
+        for m in sorted(manifest)
+    ]
+    if not df.empty:
+        live_month = f"{datetime.now().strftime('%Y-%m')} (live)"
+        parts.append(live_aggregates(version, df).assign(month=live_month))
+    return pd.concat(parts, ignore_index=True)
 
 def auto_month_snapshot_and_reset():
     """
@@ -269,62 +1211,1028 @@ def auto_month_snapshot_and_reset():
     year, month = now.year, now.month
     last_day = monthrange(year, month)[1]
     month_key = f"{year}-{month:02d}"
-    snapshot_path = SNAPSHOT_DIR / f"mason_data_{month_key}.xlsx"
 
-    # Only act on the last day of the month, and only once
-    if now.day == last_day and not snapshot_path.exists():
+    def snapshot_and_reset(current: pd.DataFrame):
+        # Checked again under the store lock: another session may have done it
+        if month_key in load_snapshot_manifest():
+            return None
+
         # Save snapshot
-        save_month_snapshot(st.session_state["data"], month_key=month_key)
+        save_month_snapshot(current, month_key=month_key)
 
         # Clear visit / register columns
-        for col in ["Visited_Status", "Visited_At", "Registered_Status", "Registered_At"]:
-            if col in st.session_state["data"].columns:
-                st.session_state["data"][col] = ""
+        df = current.copy()
+        for col in STATUS_LABELS:
+            df[col] = False
+        for col in DATE_COLUMNS:
+            df[col] = pd.NaT
+        return df
 
+    # Only act on the last day of the month, and only once. Both steps are
+    # based on the frame in the store once the startup refresh has landed,
+    # not on a cached copy that refresh is about to replace.
+    if now.day == last_day and month_key not in load_snapshot_manifest():
         # Persist cleared data
-        write_sheet(st.session_state["data"].copy(), GOOGLE_SHEET_ID, SHEET_TAB_NAME)
+        store.commit(snapshot_and_reset)
 
 # You can keep SNAPSHOT_DIR if you still want file snapshots, or delete it if not needed.
 DATA_FILE = "mason_data.xlsx"  # optional now; not used for main persistence
 
-def get_initial_dataset() -> pd.DataFrame:
+def get_initial_dataset() -> tuple[pd.DataFrame, Exception | None]:
+    """Read the master tab; on failure return an empty dataset and the error."""
     try:
         df = read_sheet(GOOGLE_SHEET_ID, SHEET_TAB_NAME)
         if df.empty:
-            st.warning(f"Google Sheet tab '{SHEET_TAB_NAME}' is empty. Starting with blank dataset.")
             df = pd.DataFrame(columns=[
                 "S.NO", "MASON CODE", "MASON NAME", "CONTACT NUMBER",
                 "DLR NAME", "Location", "DAY", "Category",
                 "HW305", "HW101", "Hw201", "HW103", "HW302", "HW310", "other",
                 "Visited_Status", "Visited_At", "Registered_Status", "Registered_At"
             ])
-        else:
-            st.success(f"Loaded {len(df)} rows from Google Sheet '{SHEET_TAB_NAME}'.")
-        return clean_dataframe(df)
+        error = None
     except Exception as e:
-        st.error("❌ Failed to load data from Google Sheets. Starting with empty dataset.")
-        st.exception(e)
         df = pd.DataFrame(columns=[
             "S.NO", "MASON CODE", "MASON NAME", "CONTACT NUMBER",
             "DLR NAME", "Location", "DAY", "Category",
             "HW305", "HW101", "Hw201", "HW103", "HW302", "HW310", "other",
             "Visited_Status", "Visited_At", "Registered_Status", "Registered_At"
         ])
-        return df
+        error = e
+    return clean_dataframe(df), error
+
+class ContactIndex:
+    """
+    Substring index over phone numbers. Every 1-, 2- and 3-digit gram of each
+    number maps to the sorted row positions containing it, so a query of up to
+    three digits is one lookup and a longer one intersects its trigram lists
+    and verifies the few candidates. Rows edited after the build are kept in
+    an overlay and checked directly until the next rebuild.
+    """
+
+    POW10 = 10 ** np.arange(16, dtype=np.int64)
+
+    def __init__(self, contacts: pd.Series):
+        valid = contacts.notna().to_numpy()
+        rows = np.flatnonzero(valid)
+        numbers = contacts[valid].to_numpy(dtype=np.int64)
+        self.numbers = np.full(len(contacts), -1, dtype=np.int64)
+        self.numbers[rows] = numbers
+        self.edited = {}  # row position -> new number (or None)
+
+        # Digit count of each number; grams are keyed 10**n + value so "05" != "5"
+        lengths = np.maximum(np.searchsorted(self.POW10, numbers, side="right"), 1)
+        keys, owners = [], []
+        for n in (1, 2, 3):
+            for offset in range(int(lengths.max(initial=0)) - n + 1):
+                ok = offset + n <= lengths
+                gram = (numbers[ok] // self.POW10[lengths[ok] - offset - n]) % self.POW10[n]
+                keys.append(self.POW10[n] + gram)
+                owners.append(rows[ok])
+
+        self.postings = {}
+        if keys:
+            keys, owners = np.concatenate(keys), np.concatenate(owners)
+            order = np.lexsort((owners, keys))
+            keys, owners = keys[order], owners[order]
+            # A number can contain the same gram twice; keep one posting per row
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = (keys[1:] != keys[:-1]) | (owners[1:] != owners[:-1])
+            keys, owners = keys[first], owners[first]
+            bounds = np.flatnonzero(np.diff(keys)) + 1
+            for key, group in zip(keys[np.r_[0, bounds]], np.split(owners, bounds)):
+                self.postings[int(key)] = group
+
+    def search(self, digits: str) -> np.ndarray:
+        """Sorted row positions whose number contains `digits`."""
+        empty = np.empty(0, dtype=np.int64)
+        if not digits:
+            return empty
+        if len(digits) <= 3:
+            hits = self.postings.get(int(10 ** len(digits)) + int(digits), empty)
+        else:
+            lists = sorted(
+                (self.postings.get(1000 + int(digits[i:i + 3]), empty) for i in range(len(digits) - 2)),
+                key=len,
+            )
+            hits = lists[0]
+            for other in lists[1:]:
+                if not len(hits):
+                    break
+                hits = np.intersect1d(hits, other, assume_unique=True)
+            hits = np.array([p for p in hits if digits in str(self.numbers[p])], dtype=np.int64)
+
+        if self.edited:
+            edited = np.fromiter(self.edited, dtype=np.int64)
+            hits = hits[~np.isin(hits, edited)]
+            extra = [p for p, number in self.edited.items() if number is not None and digits in str(number)]
+            hits = np.union1d(hits, np.array(extra, dtype=np.int64))
+        return hits
+
+class FilterIndex:
+    """
+    Inverted index over the master: column -> {value: packed row bitmap}.
+    Any combination of equality filters is answered with bitmap ANDs and only
+    the final row set is materialized. Bits are row positions in the frame the
+    index was built from; update_cells keeps them current for in-place edits.
+
+    Products are kept separately as one uint8 per row (bit i = HW_COLUMNS[i]),
+    so product filters and per-product counts are integer bit operations.
+    Conditions on it: ("has_product", bool) and ("products", required_bits).
+    ("contact", digits) matches phone numbers containing digits, through a
+    ContactIndex built on the first such query.
+    """
+
+    COLUMNS = ["DAY", "Location", "DLR NAME", "Category", "Visited_Status", "Registered_Status"]
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.n = len(df)
+        self._contacts = None
+        self.all_rows = np.packbits(np.ones(self.n, dtype=bool))
+        self.bitmaps = {}
+        for col in self.COLUMNS:
+            if col in df.columns:
+                self.bitmaps[col] = self._build(df[col])
+        self._products = self.product_bits(df)
+        self.products = self._products[:self.n]
+
+    @staticmethod
+    def product_bits(df: pd.DataFrame) -> np.ndarray:
+        bits = np.zeros(len(df), dtype=np.uint8)
+        for i, col in enumerate(HW_COLUMNS):
+            if col in df.columns:
+                bits |= df[col].to_numpy(dtype=bool).astype(np.uint8) << i
+        return bits
+
+    def product_counts(self, positions: np.ndarray) -> pd.Series:
+        """Rows interested in each product, among the given row positions."""
+        bits = self.products[positions]
+        return pd.Series(
+            [np.count_nonzero(bits & (1 << i)) for i in range(len(HW_COLUMNS))],
+            index=HW_COLUMNS,
+        )
+
+    @staticmethod
+    def _build(s: pd.Series) -> dict:
+        codes, uniques = pd.factorize(s)
+        return {value: np.packbits(codes == i) for i, value in enumerate(uniques)}
+
+    def contact_index(self) -> ContactIndex:
+        if self._contacts is None:
+            self._contacts = ContactIndex(
+                self.df["CONTACT NUMBER"] if "CONTACT NUMBER" in self.df.columns
+                else pd.Series(pd.NA, index=self.df.index, dtype="Int64")
+            )
+        return self._contacts
+
+    def contact_changed(self, pos: int, number):
+        if self._contacts is not None:
+            self._contacts.edited[pos] = None if pd.isna(number) else int(number)
+
+    def match(self, conditions: list[tuple[str, object]]) -> np.ndarray:
+        """Boolean row mask for rows where every (column, value) holds."""
+        bits = self.all_rows.copy()
+        empty = np.zeros_like(bits)
+        row_mask = np.ones(self.n, dtype=bool)
+        for col, value in conditions:
+            if col == "has_product":
+                row_mask &= (self.products != 0) == value
+            elif col == "products":
+                row_mask &= (self.products & value) == value
+            elif col == "contact":
+                hits = np.zeros(self.n, dtype=bool)
+                hits[self.contact_index().search(value)] = True
+                row_mask &= hits
+            else:
+                bits &= self.bitmaps.get(col, {}).get(value, empty)
+        return np.unpackbits(bits, count=self.n).astype(bool) & row_mask
+
+    def move(self, pos: int, column: str, old, new):
+        """Move row `pos` from the `old` to the `new` bitmap of `column`."""
+        maps = self.bitmaps.get(column)
+        if maps is None or old == new:
+            return
+        byte, bit = pos >> 3, np.uint8(0x80 >> (pos & 7))
+        if old in maps:
+            maps[old][byte] &= ~bit
+        maps.setdefault(new, np.zeros_like(self.all_rows))[byte] |= bit
+
+    def append(self, df: pd.DataFrame):
+        """
+        Index the last row of df, the indexed frame plus one row. Bitmaps and
+        product bits keep spare room that doubles when used up, so appends
+        cost amortized O(1); bits past `n` stay zero.
+        """
+        pos = self.n
+        byte, bit = pos >> 3, np.uint8(0x80 >> (pos & 7))
+        if byte == len(self.all_rows):
+            def grow(bits):
+                return np.concatenate([bits, np.zeros(len(bits) + 1, dtype=bits.dtype)])
+            self.all_rows = grow(self.all_rows)
+            for maps in self.bitmaps.values():
+                for value in maps:
+                    maps[value] = grow(maps[value])
+        if pos == len(self._products):
+            self._products = np.concatenate([self._products, np.zeros(pos + 1, dtype=np.uint8)])
+
+        self.all_rows[byte] |= bit
+        for col, maps in self.bitmaps.items():
+            maps.setdefault(df[col].iat[pos], np.zeros_like(self.all_rows))[byte] |= bit
+        self._products[pos] = self.product_bits(df.iloc[[pos]])[0]
+        self.df = df
+        self.n = pos + 1
+        self.products = self._products[:self.n]
+        if "CONTACT NUMBER" in df.columns:
+            self.contact_changed(pos, df["CONTACT NUMBER"].iat[pos])
+
+AGGREGATE_GROUPS = ["Location", "DLR NAME", "DAY", "Category"]
+AGGREGATE_ROW_COLUMNS = AGGREGATE_GROUPS + list(STATUS_LABELS) + HW_COLUMNS + ["CONTACT NUMBER"]
+AGGREGATE_CACHE_SIZE = 32  # filter sets kept per dataset
+
+class DisplayAggregates:
+    """
+    KPI and chart counters for one filter set: matching rows, visited,
+    registered, row counts per group column and per-product interest.
+    Built with one pass over the matching rows, then patched one row at a
+    time by DatasetStore.update_cells, so an edit never rescans the data.
+    `version` is the dataset version the counters describe.
+    """
+
+    def __init__(self, conditions: list[tuple[str, object]], rows: pd.DataFrame,
+                 products: pd.Series, version: int):
+        self.conditions = conditions
+        self.version = version
+        self.rows = len(rows)
+        self.visited = int(rows["Visited_Status"].sum()) if "Visited_Status" in rows.columns else 0
+        self.registered = int(rows["Registered_Status"].sum()) if "Registered_Status" in rows.columns else 0
+        self.groups = {
+            col: {k: int(v) for k, v in _as_text(rows[col]).value_counts().items()}
+            for col in AGGREGATE_GROUPS if col in rows.columns
+        }
+        self.products = {p: int(n) for p, n in products.items()}
+
+    def matches(self, row: dict) -> bool:
+        """Whether a row (column -> value) satisfies every condition."""
+        for col, value in self.conditions:
+            if col == "has_product":
+                if any(bool(row.get(p)) for p in HW_COLUMNS) != value:
+                    return False
+            elif col == "products":
+                if any(value & (1 << i) and not row.get(p) for i, p in enumerate(HW_COLUMNS)):
+                    return False
+            elif col == "contact":
+                number = row.get("CONTACT NUMBER")
+                if pd.isna(number) or value not in str(int(number)):
+                    return False
+            elif row.get(col) != value:
+                return False
+        return True
+
+    def _count(self, row: dict, sign: int):
+        self.rows += sign
+        self.visited += sign * bool(row.get("Visited_Status"))
+        self.registered += sign * bool(row.get("Registered_Status"))
+        for col, counts in self.groups.items():
+            key = "" if pd.isna(row.get(col)) else str(row.get(col))
+            counts[key] = counts.get(key, 0) + sign
+        for p in self.products:
+            self.products[p] += sign * bool(row.get(p))
+
+    def patch(self, old_row: dict, new_row: dict):
+        """Move one edited row's contribution from its old to its new values."""
+        if self.matches(old_row):
+            self._count(old_row, -1)
+        if self.matches(new_row):
+            self._count(new_row, +1)
+
+    def add(self, row: dict):
+        """Count one appended row."""
+        if self.matches(row):
+            self._count(row, +1)
+
+    def counts(self, column: str) -> pd.Series:
+        """Rows per value of `column`, largest first, like value_counts()."""
+        counts = pd.Series(self.groups.get(column, {}), dtype=int)
+        return counts[counts > 0].sort_values(ascending=False)
+
+    def distinct(self, column: str) -> int:
+        return sum(1 for n in self.groups.get(column, {}).values() if n > 0)
+
+class DatasetStore:
+    """
+    The master dataset, shared by every session in this process.
+    Sessions read `df` directly instead of keeping private copies. Row and
+    column changes publish a new frame (copy-on-write) so readers holding the
+    old one are unaffected; single-cell edits are applied in place. Every
+    mutation bumps `version` and queues the sheet write.
+
+    `row_versions` maps each S.NO to the version that last changed its row,
+    so writes prepared against an older read can be merged with
+    compare_and_set instead of overwriting other sessions' edits.
+
+    Rows are found through a maintained S.NO -> position hash (`locate`)
+    rather than by scanning the column, and new S.NOs come from a monotonic
+    allocator (`allocate_snos`) that never hands out a number twice.
+    Likewise each UNIQUE_COLUMNS value maps to the S.NOs holding it, so a
+    new row's duplicates are found without scanning (`duplicates`).
+
+    Startup is stale-while-revalidate: if a local cache exists it is served
+    immediately while Google Sheets is read in the background. Mutations
+    wait for that refresh so edits are never applied to stale rows.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = 0
+        self.df = None
+        self._index = None  # FilterIndex for self.df, built on first use
+        self._aggregates = {}  # filter set -> DisplayAggregates, least recently used first
+        self._spare = None  # frame whose leading rows are self.df, with room to append
+        self.row_versions = {}  # S.NO -> version of the last change to that row
+        self._positions = {}  # S.NO -> row position (the first, for a repeated S.NO)
+        self._repeated = set()  # S.NOs held by more than one row
+        self._next_sno = 1  # lowest S.NO the allocator may still hand out
+        self._holders = {}  # unique column -> unique_key -> tuple of S.NOs holding it
+        self.load_error = None
+        self.fresh = threading.Event()  # set once Google Sheets has been read
+
+        cached = load_master_cache()
+        if cached is None:
+            self.load()
+        else:
+            self.df = cached
+            self.version += 1
+            self._index_rows()
+            threading.Thread(target=self.load, name="master-revalidate", daemon=True).start()
+
+    def load(self):
+        """(Re)read the master from Google Sheets and publish it."""
+        df, error = get_initial_dataset()
+        with self.lock:
+            # On failure keep serving the cached copy if there is one
+            if error is None or self.df is None:
+                self.df = df
+                self._index = None
+                self._aggregates.clear()
+                self._spare = None
+                self.version += 1
+                self._index_rows()
+            self.load_error = error
+        if error is None:
+            save_master_cache(df)
+        self.fresh.set()
+
+    def commit(self, df, full: bool = False):
+        """
+        Publish df as the new master frame. df may instead be a function of
+        the current frame, called under the lock once the startup refresh
+        has landed, for changes that must be based on the latest data; if it
+        returns None nothing is published.
+        """
+        self.fresh.wait()
+        with self.lock:
+            if callable(df):
+                df = df(self.df)
+                if df is None:
+                    return
+            # Row labels double as row positions for the index
+            if not df.index.equals(pd.RangeIndex(len(df))):
+                df = df.reset_index(drop=True)
+            self.df = df
+            self._index = None
+            self._aggregates.clear()
+            self._spare = None
+            self.version += 1
+            self._index_rows()
+            queue_sheet_write(df, GOOGLE_SHEET_ID, SHEET_TAB_NAME, full=full)
+
+    def _index_rows(self):
+        """After a whole-frame publish every row counts as changed in this version."""
+        snos = self.df["S.NO"].tolist() if "S.NO" in self.df.columns else []
+        self.row_versions = dict.fromkeys(snos, self.version)
+        self._index_positions(snos)
+        self._index_keys(snos)
+
+    def _index_positions(self, snos: list):
+        # Filled back to front so a repeated S.NO keeps its first position
+        self._positions = dict(zip(reversed(snos), range(len(snos) - 1, -1, -1)))
+        seen, self._repeated = set(), set()
+        for sno in snos:
+            (self._repeated if sno in seen else seen).add(sno)
+        self._next_sno = max(self._next_sno, max(snos, default=0) + 1)
+
+    def _index_keys(self, snos: list):
+        self._holders = {}
+        snos = pd.Series(snos, index=self.df.index, dtype=object)
+        for col in UNIQUE_COLUMNS:
+            if col in self.df.columns:
+                keys = unique_keys(col, self.df[col]).astype(object)
+                held = keys.notna()
+                keys, holders = keys[held], snos[held]
+                shared = keys.duplicated(keep=False)
+                self._holders[col] = {
+                    key: (sno,) for key, sno in zip(keys[~shared].tolist(), holders[~shared].tolist())
+                }
+                for key, group in holders[shared].groupby(keys[shared], sort=False):
+                    self._holders[col][key] = tuple(group.tolist())
+
+    def _rekey(self, sno: int, col: str, old, new):
+        """Move `sno` from the holders of old's key to those of new's."""
+        holders = self._holders[col]
+        key = unique_key(col, old)
+        if key in holders:
+            holders[key] = tuple(held for held in holders[key] if held != sno)
+            if not holders[key]:
+                del holders[key]
+        key = unique_key(col, new)
+        if key is not None and sno not in holders.get(key, ()):
+            holders[key] = holders.get(key, ()) + (sno,)
+
+    def duplicates(self, values: dict, exclude: int | None = None) -> dict:
+        """
+        For a prospective row (column -> value), the UNIQUE_COLUMNS whose
+        value other rows already hold, each with those rows' S.NOs. The row
+        `exclude` (the one being edited) does not count.
+        """
+        with self.lock:
+            found = {}
+            for col, holders in self._holders.items():
+                if col in values:
+                    held = [sno for sno in holders.get(unique_key(col, values[col]), ()) if sno != exclude]
+                    if held:
+                        found[col] = sorted(held)
+            return found
+
+    def duplicate_report(self, snos=None) -> pd.DataFrame:
+        """
+        One line per row whose UNIQUE_COLUMNS value other rows share:
+        Column, Value, S.NO and MASON NAME, grouped by value. With `snos`
+        only values held by those rows are reported; the work is linear in
+        the rows given (or in the master when snos is None).
+        """
+        with self.lock:
+            df = self.df
+            lines = []
+            for col, holders in self._holders.items():
+                if snos is None:
+                    keys = [key for key, held in holders.items() if len(held) > 1]
+                else:
+                    j = df.columns.get_loc(col)
+                    keys = {unique_key(col, df.iat[p[0], j]) for p in self.locate(snos).values()}
+                    keys = [key for key in keys if len(holders.get(key, ())) > 1]
+                lines += [(col, key, sno) for key in keys for sno in sorted(holders[key])]
+            report = pd.DataFrame(lines, columns=["Column", "Value", "S.NO"])
+            report["Value"] = report["Value"].astype(str)
+            if "MASON NAME" in df.columns:
+                first = {sno: p[0] for sno, p in self.locate(set(report["S.NO"])).items()}
+                names = df["MASON NAME"].to_numpy()
+                report["MASON NAME"] = [names[first[sno]] for sno in report["S.NO"]]
+            return report
+
+    def locate(self, snos) -> dict:
+        """S.NO -> list of row positions, for those of `snos` in the master."""
+        with self.lock:
+            found, repeated = {}, []
+            for sno in snos:
+                if sno in self._repeated:
+                    repeated.append(sno)
+                elif sno in self._positions:
+                    found[sno] = [self._positions[sno]]
+            if repeated:
+                # Only S.NOs shared by several rows need a scan
+                sno_col = self.df["S.NO"].to_numpy()
+                for pos in np.flatnonzero(np.isin(sno_col, repeated)):
+                    found.setdefault(sno_col[pos].item(), []).append(int(pos))
+            return found
+
+    def allocate_snos(self, count: int = 1, above: int = 0) -> int:
+        """
+        Reserve `count` consecutive new S.NOs, all greater than `above`, and
+        return the first. Numbers are never handed out twice, even after the
+        rows holding them are deleted, so an undone delete cannot collide.
+        """
+        with self.lock:
+            first = max(self._next_sno, int(above) + 1)
+            self._next_sno = first + count
+            return first
+
+    def filter_index(self) -> FilterIndex:
+        with self.lock:
+            if self._index is None:
+                self._index = FilterIndex(self.df)
+            return self._index
+
+    def snapshot(self) -> tuple[int, pd.DataFrame]:
+        """The current (version, frame) pair, read consistently."""
+        with self.lock:
+            return self.version, self.df
+
+    def row(self, sno: int) -> pd.Series | None:
+        """The current row with this S.NO, or None if there is none."""
+        with self.lock:
+            positions = self.locate([sno]).get(sno)
+            return self.df.iloc[positions[0]] if positions else None
+
+    def rows(self, snos: list) -> tuple[int, pd.DataFrame]:
+        """
+        (version, current rows with these S.NOs in the order given), indexed
+        by row position; S.NOs no longer in the master are left out.
+        """
+        with self.lock:
+            found = self.locate(snos)
+            return self.version, self.df.iloc[[found[sno][0] for sno in snos if sno in found]]
+
+    def select(self, conditions: list[tuple[str, object]]) -> pd.DataFrame:
+        """Rows matching all (column, value) conditions, via the bitmap index."""
+        with self.lock:
+            if not conditions:
+                return self.df
+            return self.df[self.filter_index().match(conditions)]
+
+    def product_counts(self, rows: pd.DataFrame) -> pd.Series:
+        """Per-product interest counts for rows selected from the master."""
+        with self.lock:
+            positions = rows.index.to_numpy()
+            if len(positions) and positions.max() >= len(self.df):
+                # rows came from an older frame; count them directly
+                return rows[[c for c in HW_COLUMNS if c in rows.columns]].sum()
+            return self.filter_index().product_counts(positions)
+
+    def aggregates(self, conditions: list[tuple[str, object]]) -> DisplayAggregates:
+        """KPI/chart counters for this filter set, cached and kept current by edits."""
+        key = tuple(conditions)
+        with self.lock:
+            agg = self._aggregates.pop(key, None)
+            if agg is None or agg.version != self.version:
+                rows = self.select(conditions)
+                agg = DisplayAggregates(conditions, rows, self.product_counts(rows), self.version)
+            self._aggregates[key] = agg
+            while len(self._aggregates) > AGGREGATE_CACHE_SIZE:
+                self._aggregates.pop(next(iter(self._aggregates)))
+            return agg
+
+    def _aggregate_row(self, pos: int) -> dict:
+        df = self.df
+        return {col: df.iat[pos, df.columns.get_loc(col)]
+                for col in AGGREGATE_ROW_COLUMNS if col in df.columns}
+
+    def set_cells(self, sno: int, values: dict) -> list[tuple]:
+        """Set {column: value} on the row with this S.NO; returns the changes made."""
+        return self.update_cells([(sno, col, val) for col, val in values.items()])
+
+    def update_cells(self, cells: list[tuple[int, str, object]]) -> list[tuple]:
+        """
+        Set many (S.NO, column, value) cells in place, grouped per column.
+        Returns (S.NO, column, old, new) for every cell that actually changed;
+        unknown S.NOs and columns are skipped.
+        """
+        self.fresh.wait()
+        with self.lock:
+            df = self.df
+            if "S.NO" not in df.columns or not cells:
+                return []
+            sno_col = df["S.NO"].to_numpy()
+            rows_of = self.locate({c[0] for c in cells})
+
+            by_column = {}
+            for sno, col, val in cells:
+                if col not in df.columns:
+                    continue
+                val = coerce_cell(col, val)
+                for pos in rows_of.get(sno, ()):
+                    by_column.setdefault(col, {})[pos] = val
+
+            index = self._index
+            touched = {pos for updates in by_column.values() for pos in updates}
+            aggregates = [a for a in self._aggregates.values() if a.version == self.version]
+            before = {pos: self._aggregate_row(pos) for pos in touched} if aggregates else {}
+            changes = []
+            for col, updates in by_column.items():
+                positions = np.fromiter(updates, dtype=np.intp, count=len(updates))
+                values = list(updates.values())
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    missing = set(values) - set(df[col].cat.categories)
+                    if missing:
+                        if self._spare is not None:
+                            # Widen the append buffer's column and re-slice, so both stay shared
+                            self._spare[col] = self._spare[col].cat.add_categories(sorted(missing))
+                            self.df = df = self._spare.iloc[:len(df)]
+                            if index is not None:
+                                index.df = df
+                        else:
+                            df[col] = df[col].cat.add_categories(sorted(missing))
+                j = df.columns.get_loc(col)
+                olds = df.iloc[positions, j].tolist()
+                for pos, old, val in zip(positions, olds, values):
+                    if not _same_value(old, val):
+                        changes.append((sno_col[pos].item(), col, old, val))
+                        if index is not None:
+                            index.move(pos, col, old, val)
+                            if col == "CONTACT NUMBER":
+                                index.contact_changed(pos, val)
+                df.iloc[positions, j] = values
+                if index is not None and col in HW_COLUMNS:
+                    index.products[positions] = FilterIndex.product_bits(df.iloc[positions])
+
+            if changes:
+                self.version += 1
+                for sno, *_ in changes:
+                    self.row_versions[sno] = self.version
+                if "S.NO" in by_column:
+                    self._index_positions(df["S.NO"].tolist())
+                    self._index_keys(df["S.NO"].tolist())
+                else:
+                    for sno, col, old, new in changes:
+                        if col in self._holders:
+                            self._rekey(sno, col, old, new)
+                for agg in aggregates:
+                    for pos in touched:
+                        agg.patch(before[pos], self._aggregate_row(pos))
+                    agg.version = self.version
+                queue_sheet_write(df, GOOGLE_SHEET_ID, SHEET_TAB_NAME)
+            return changes
+
+    def compare_and_set(self, cells: list[tuple], base_version: int | None = None) -> tuple[list, list]:
+        """
+        Three-way merge of (S.NO, column, old, new) writes prepared against an
+        earlier read of the data. Rows nobody changed after `base_version`
+        take the writes as they are; otherwise each cell is checked: if it
+        still holds `old` the write goes in, if it already holds `new` there
+        is nothing to do, and anything else is a conflict that is skipped.
+        With no base_version every cell is checked.
+        Returns (changes made, conflicts as (S.NO, column, new, current)).
+        """
+        self.fresh.wait()
+        with self.lock:
+            df = self.df
+            writes, check = [], []
+            for sno, col, old, new in cells:
+                if base_version is not None and self.row_versions.get(sno, base_version + 1) <= base_version:
+                    writes.append((sno, col, new))
+                else:
+                    check.append((sno, col, old, new))
+
+            position_of = self.locate({c[0] for c in check}) if check else {}
+
+            conflicts = []
+            for sno, col, old, new in check:
+                pos = position_of.get(sno, [None])[0]
+                current = df.iat[pos, df.columns.get_loc(col)] if pos is not None and col in df.columns else None
+                if pos is not None and _same_value(current, coerce_cell(col, old)):
+                    writes.append((sno, col, new))
+                elif pos is None or not _same_value(current, coerce_cell(col, new)):
+                    conflicts.append((sno, col, new, current))
+            return self.update_cells(writes), conflicts
+
+    def append_unique(self, values: dict) -> tuple[pd.DataFrame | None, dict]:
+        """
+        append_row() unless other rows already hold the row's UNIQUE_COLUMNS
+        values; checked and added under one lock, so two sessions cannot add
+        the same mason at once. Returns (added row or None, duplicates).
+        """
+        self.fresh.wait()
+        with self.lock:
+            duplicates = self.duplicates(values)
+            return (None if duplicates else self.append_row(values)), duplicates
+
+    def append_row(self, values: dict) -> pd.DataFrame:
+        """
+        Add one row (column -> value, as entered) at the end of the master
+        and return it as a one-row frame. The master is a prefix view of a
+        larger buffer, so this writes one row instead of copying the frame;
+        the buffer doubles when full, keeping appends amortized O(1). The
+        index and cached aggregates are extended, not rebuilt, and the sheet
+        write is a pure append.
+        """
+        self.fresh.wait()
+        with self.lock:
+            df = self.df
+            if not set(values) <= set(df.columns):
+                # New columns: only a whole new frame can hold them
+                self.commit(clean_dataframe(pd.concat([df, pd.DataFrame([values])], ignore_index=True)))
+                return self.df.iloc[[-1]]
+            # One row: coerce cell by cell instead of running clean_dataframe
+            row = pd.DataFrame({
+                col: pd.Series(
+                    [coerce_cell(col, values.get(col))],
+                    dtype="category" if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].dtype,
+                )
+                for col in df.columns
+            })
+
+            n = len(df)
+            spare = self._spare
+            if spare is None or len(spare) == n:
+                spare = self._grown(df, row)
+            else:
+                for j, col in enumerate(df.columns):
+                    value = row[col].iat[0]
+                    if isinstance(spare[col].dtype, pd.CategoricalDtype) and value not in spare[col].cat.categories:
+                        spare[col] = spare[col].cat.add_categories([value])
+                    spare.iat[n, j] = value
+            aggregates = [a for a in self._aggregates.values() if a.version == self.version]
+            self._spare = spare
+            self.df = df = spare.iloc[:n + 1]
+            self.version += 1
+            sno = df["S.NO"].iat[n].item()
+            self.row_versions[sno] = self.version
+            if sno in self._positions:
+                self._repeated.add(sno)
+            else:
+                self._positions[sno] = n
+            self._next_sno = max(self._next_sno, sno + 1)
+            for col in self._holders:
+                self._rekey(sno, col, None, df[col].iat[n])
+
+            if self._index is not None:
+                self._index.append(df)
+            if aggregates:
+                added = self._aggregate_row(n)
+                for agg in aggregates:
+                    agg.add(added)
+                    agg.version = self.version
+            queue_sheet_write(df, GOOGLE_SHEET_ID, SHEET_TAB_NAME)
+            return df.iloc[[n]]
+
+    @staticmethod
+    def _grown(df: pd.DataFrame, row: pd.DataFrame) -> pd.DataFrame:
+        """df followed by `row` repeated to twice df's length, dtypes unchanged."""
+        pad = row.iloc[np.zeros(max(len(df), 1), dtype=np.intp)]
+        columns = {}
+        for col in df.columns:
+            head, tail = df[col], pad[col]
+            # Concat keeps a categorical only when both sides share the categories
+            if isinstance(head.dtype, pd.CategoricalDtype):
+                categories = head.cat.categories.union(tail.cat.categories, sort=False)
+                head = head.cat.set_categories(categories)
+                tail = tail.cat.set_categories(categories)
+            columns[col] = pd.concat([head, tail], ignore_index=True)
+        return pd.DataFrame(columns)
+
+    def replace_rows(self, remove=(), insert: pd.DataFrame | None = None):
+        """
+        Drop the rows with S.NO in `remove` and put the `insert` rows back at
+        the positions held in their index, then publish the result. Used to
+        replay row-level journal entries.
+        """
+        self.fresh.wait()
+        with self.lock:
+            df = self.df
+            kept = df[~df["S.NO"].isin(list(remove))] if len(remove) else df
+            parts = [kept] if len(kept) else []
+            keys = np.arange(len(kept), dtype=float)
+            if insert is not None and len(insert):
+                insert = insert.sort_index()
+                # Each row lands after the kept rows that preceded its old position
+                slots = insert.index.to_numpy()
+                keys = np.concatenate([keys, slots - np.arange(len(slots)) - 0.5])
+                parts.append(insert)
+            combined = pd.concat(parts, ignore_index=True) if parts else df.iloc[0:0]
+            combined = combined.iloc[np.argsort(keys, kind="stable")]
+            self.commit(clean_dataframe(combined.reset_index(drop=True)))
+
+@st.cache_resource
+def get_dataset_store() -> DatasetStore:
+    return DatasetStore()
+
+
+# ------------ UNDO / REDO JOURNAL ------------
+
+# Per-session history bounds: whichever is hit first evicts the oldest step
+JOURNAL_MAX_STEPS = 50
+JOURNAL_MAX_BYTES = 8 * 1024 * 1024
+CELL_FIELDS = ["S.NO", "column", "old", "new"]
+
+class JournalEntry:
+    """
+    One undoable operation: the cells it changed as (S.NO, column, old, new)
+    rows, plus any whole rows it inserted or removed (indexed by position).
+    """
+
+    def __init__(self, label: str, cells: list[tuple] = (),
+                 added: pd.DataFrame | None = None, removed: pd.DataFrame | None = None):
+        self.label = label
+        self.cells = pd.DataFrame(list(cells), columns=CELL_FIELDS, dtype=object)
+        self.added = added
+        self.removed = removed
+        self.nbytes = int(self.cells.memory_usage(deep=True).sum()) + sum(
+            int(rows.memory_usage(deep=True).sum())
+            for rows in (added, removed) if rows is not None
+        )
+
+    def __bool__(self) -> bool:
+        return not self.cells.empty or any(
+            rows is not None and len(rows) for rows in (self.added, self.removed)
+        )
+
+    def _replay(self, store: "DatasetStore", field: str, expect: str, drop, put,
+                base_version: int | None = None):
+        """
+        Drop and put back rows, then write the `field` side of the cells where
+        they still hold the `expect` side (DatasetStore.compare_and_set).
+        With base_version, rows to drop that someone changed since are kept.
+        Returns (cell changes made, rows dropped, conflicts).
+        """
+        conflicts = []
+        if base_version is not None and drop is not None and len(drop):
+            changed = drop["S.NO"].map(store.row_versions).gt(base_version)
+            conflicts += [(sno, None, None, None) for sno in drop.loc[changed, "S.NO"].tolist()]
+            drop = drop[~changed]
+        if (drop is not None and len(drop)) or (put is not None and len(put)):
+            store.replace_rows(drop["S.NO"].tolist() if drop is not None else (), put)
+        changes = []
+        if not self.cells.empty:
+            changes, cell_conflicts = store.compare_and_set(
+                zip(self.cells["S.NO"], self.cells["column"], self.cells[expect], self.cells[field]),
+                base_version,
+            )
+            conflicts += cell_conflicts
+        return changes, drop, conflicts
+
+    def revert(self, store: "DatasetStore") -> list[tuple]:
+        """Undo this entry; returns the cells left alone because they changed since."""
+        return self._replay(store, "old", "new", self.added, self.removed)[2]
+
+    def apply(self, store: "DatasetStore", base_version: int | None = None) -> tuple["JournalEntry", list[tuple]]:
+        """
+        (Re)do this entry, merged with edits made after base_version.
+        Returns the entry for what was actually applied, and the conflicts.
+        """
+        changes, removed, conflicts = self._replay(
+            store, "new", "old", self.removed, self.added, base_version
+        )
+        return JournalEntry(self.label, changes, added=self.added, removed=removed), conflicts
+
+def diff_frames(label: str, old: pd.DataFrame, new: pd.DataFrame) -> JournalEntry:
+    """
+    The JournalEntry turning `old` into `new`, matching rows on S.NO. Both
+    frames are indexed by master row position, which is kept on the
+    inserted and removed rows.
+    """
+    if list(old.columns) != list(new.columns) or "S.NO" not in old.columns:
+        # Schema change: only a whole-frame swap can express it
+        return JournalEntry(label, added=new, removed=old)
+
+    in_new = old["S.NO"].isin(new["S.NO"])
+    in_old = new["S.NO"].isin(old["S.NO"])
+    before = old[in_new].drop_duplicates("S.NO", keep="last").set_index("S.NO")
+    after = new[in_old].drop_duplicates("S.NO", keep="last").set_index("S.NO").reindex(before.index)
+
+    cells = []
+    for col, changed, olds, news in _column_changes(before, after):
+        snos = before.index.to_numpy()[changed]
+        cells.extend(zip(snos.tolist(), [col] * len(changed), olds.tolist(), news.tolist()))
+
+    return JournalEntry(label, cells, added=new[~in_old], removed=old[~in_new])
+
+# Visit/registration history that an upsert never overwrites on existing rows
+HISTORY_COLUMNS = list(STATUS_LABELS) + DATE_COLUMNS
+
+def upsert_frames(label: str, master: pd.DataFrame, incoming: pd.DataFrame,
+                  allocate, key: str = "MASON CODE") -> JournalEntry:
+    """
+    The JournalEntry merging `incoming` into `master` by `key`: rows whose
+    key exists in master update the cells that differ (history columns
+    excepted), all other rows are appended with fresh S.NOs taken from
+    `allocate(count)` (DatasetStore.allocate_snos). Master rows
+    missing from `incoming` are left alone, and so are cells whose incoming
+    value is missing (blank in the file). Keys match as unique_key() does,
+    so "c5" updates the master's "C5". For a repeated key the last
+    incoming row wins; rows with a blank key are always new.
+    """
+    keys = unique_keys(key, incoming[key]).astype(object)
+    incoming = incoming[~(keys.notna() & keys.duplicated(keep="last"))]
+    keys = keys[incoming.index]
+
+    master_keys = unique_keys(key, master[key]).astype(object)
+    position_of = pd.Series(master.index, index=master_keys.to_numpy())
+    position_of = position_of[position_of.index.notna() & ~position_of.index.duplicated()]
+    positions = keys.map(position_of)
+    matched = positions.notna()
+
+    cols = [c for c in incoming.columns
+            if c in master.columns and c not in HISTORY_COLUMNS and c not in ("S.NO", key)]
+    before = master.loc[positions[matched].astype(int), cols]
+    after = incoming.loc[matched, cols]
+    snos = master.loc[before.index, "S.NO"].to_numpy()
+    before.index = after.index = snos
+    cells = []
+    for col, changed, olds, news in _column_changes(before, after):
+        given = pd.notna(news)
+        changed, olds, news = changed[given], olds[given], news[given]
+        cells.extend(zip(snos[changed].tolist(), [col] * len(changed), olds.tolist(), news.tolist()))
+
+    added = incoming[~matched].reindex(columns=master.columns)
+    start = allocate(len(added)) if len(added) else 1
+    added["S.NO"] = np.arange(start, start + len(added))
+    added = clean_dataframe(added)
+    added.index = len(master) + np.arange(len(added))
+    return JournalEntry(label, cells, added=added)
+
+class EditJournal:
+    """
+    A session's undo/redo history of JournalEntry steps, bounded by
+    JOURNAL_MAX_STEPS and JOURNAL_MAX_BYTES. Undo and redo replay only the
+    recorded cells and rows, so the sheet gets a targeted update.
+    """
+
+    def __init__(self):
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def record(self, entry: JournalEntry):
+        if not entry:
+            return
+        self.redo_stack.clear()
+        if entry.nbytes > JOURNAL_MAX_BYTES:
+            # Too big to keep; older steps can't be replayed across it either
+            self.undo_stack.clear()
+            return
+        self.undo_stack.append(entry)
+        while (len(self.undo_stack) > JOURNAL_MAX_STEPS
+               or sum(e.nbytes for e in self.undo_stack) > JOURNAL_MAX_BYTES):
+            self.undo_stack.pop(0)
+
+    def undo(self, store: DatasetStore) -> list[tuple]:
+        """Revert the last step; returns its cells that others changed since (left alone)."""
+        if not self.undo_stack:
+            return []
+        entry = self.undo_stack.pop()
+        conflicts = entry.revert(store)
+        self.redo_stack.append(entry)
+        return conflicts
+
+    def redo(self, store: DatasetStore) -> list[tuple]:
+        if not self.redo_stack:
+            return []
+        done, conflicts = self.redo_stack.pop().apply(store)
+        if done:
+            self.undo_stack.append(done)
+        return conflicts
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def cascade_options(version: int, _df: pd.DataFrame) -> dict:
+    """
+    Option lists for the Day -> Location -> DLR -> Category dropdowns, computed
+    once per dataset version from the distinct (day, location, dlr, category)
+    tuples. Every level is keyed by the selections above it, "All" included,
+    so changing a selection is a dictionary lookup. Shared, treat as read-only.
+    """
+    levels = ["DAY", "Location", "DLR NAME", "Category"]
+    combos = pd.DataFrame({
+        col: _as_text(_df[col]).str.strip() if col in _df.columns else ""
+        for col in levels
+    }, index=_df.index).drop_duplicates()
+
+    locations, dlrs, categories = {}, {}, {}
+    for day, loc, dlr, cat in combos.itertuples(index=False):
+        for d in (day, "All"):
+            locations.setdefault(d, set()).add(loc)
+            for l in (loc, "All"):
+                dlrs.setdefault((d, l), set()).add(dlr)
+                for r in (dlr, "All"):
+                    categories.setdefault((d, l, r), set()).add(cat)
+
+    def options(values: set) -> list:
+        return ["All"] + sorted(v for v in values if v)
+
+    return {
+        "days": options(set(combos["DAY"])),
+        "locations": {k: options(v) for k, v in locations.items()},
+        "dlrs": {k: options(v) for k, v in dlrs.items()},
+        # Category also offers a blank bucket when uncategorized rows exist
+        "categories": {
+            k: options(v) + (["Blank / Uncategorized"] if "" in v else [])
+            for k, v in categories.items()
+        },
+    }
 
 
 # ------------ SESSION STATE INIT ------------
 
-if "data" not in st.session_state:
-    st.session_state["data"] = get_initial_dataset()
+store = get_dataset_store()
 
-if "prev_data" not in st.session_state:
-    st.session_state["prev_data"] = None
+if "data_version" not in st.session_state:
+    # First run of this session: retry a failed load, then report it once
+    if store.load_error is not None:
+        store.load()
+    if store.load_error is not None and store.df.empty:
+        st.error("❌ Failed to load data from Google Sheets. Starting with empty dataset.")
+        st.exception(store.load_error)
+    elif store.load_error is not None:
+        st.warning(f"⚠️ Could not refresh from Google Sheets. Showing the last saved copy ({len(store.df)} rows).")
+    elif not store.fresh.is_set():
+        st.info(f"Showing {len(store.df)} cached rows while refreshing from Google Sheets…")
+    elif store.df.empty:
+        st.warning(f"Google Sheet tab '{SHEET_TAB_NAME}' is empty. Starting with blank dataset.")
+    else:
+        st.success(f"Loaded {len(store.df)} rows from Google Sheet '{SHEET_TAB_NAME}'.")
+
+st.session_state["data_version"] = store.version
 
-# Ensure status columns exist even for older files
-for col in ["Visited_Status", "Visited_At", "Registered_Status", "Registered_At"]:
-    if col not in st.session_state["data"].columns:
-        st.session_state["data"][col] = ""
+if "journal" not in st.session_state:
+    st.session_state["journal"] = EditJournal()
 
 # Run automatic month-end snapshot + reset logic
 auto_month_snapshot_and_reset()
@@ -338,9 +2246,9 @@ defaults = {
     "filter_visit_status": "All",
     "filter_reg_status": "All",
     "filter_mobile_input": "",
-    "filter_mobile_query": "",
     "filter_only_products": False,
     "filter_no_products": False,
+    "filter_products_all": [],
     "reset_filters": False,
 }
 
@@ -354,39 +2262,46 @@ if st.session_state.get("reset_filters", False):
         st.session_state[k] = v
     st.session_state["reset_filters"] = False
 
-# ------------ INLINE UPDATE FUNCTION FOR CARDS ------------
+render_sync_status()
 
-def update_entry(sno: int, column_name: str, widget_key: str, is_checkbox: bool = False):
-    """Update a single cell in st.session_state['data'] from a widget."""
-    df = st.session_state["data"]
-    if "S.NO" not in df.columns:
-        return
-    mask = df["S.NO"] == sno
-    if not mask.any():
-        return
+# ------------ INLINE UPDATE FUNCTION FOR CARDS ------------
 
+def update_entry(sno: int, column_name: str, widget_key: str, is_checkbox: bool = False, shown=None):
+    """
+    Update a single cell of the shared dataset from a widget. `shown` is the
+    value the widget was rendered with; if someone else changed the cell
+    since, their value is kept and the edit is reported as a conflict.
+    """
     if is_checkbox:
         val = bool(st.session_state.get(widget_key, False))
-        df.loc[mask, column_name] = "YES" if val else ""
     else:
         val = st.session_state.get(widget_key, "")
-        df.loc[mask, column_name] = val
-
-    st.session_state["data"] = df
-    write_sheet(st.session_state["data"].copy(), GOOGLE_SHEET_ID, SHEET_TAB_NAME)
+    changes, conflicts = store.compare_and_set([(sno, column_name, shown, val)])
+    st.session_state["journal"].record(JournalEntry(f"Edit {column_name} of #{sno}", changes))
+    report_conflicts(conflicts)
+    if changes and column_name in UNIQUE_COLUMNS:
+        report_duplicates([sno])
 
 # ------------ DATA MANAGEMENT EXPANDER ------------
 
 with st.expander("🛠️ Data Management (Import / Add / Undo / Export)", expanded=False):
 
-    # Undo
-    if st.session_state["prev_data"] is not None:
-        if st.button("↩️ Undo Last Change", type="primary"):
-            st.session_state["data"] = st.session_state["prev_data"]
-            st.session_state["prev_data"] = None
-            write_sheet(st.session_state["data"].copy(), GOOGLE_SHEET_ID, SHEET_TAB_NAME)
-            st.success("Restored previous version!")
-            st.rerun()
+    # Undo / Redo
+    journal = st.session_state["journal"]
+    if journal.undo_stack or journal.redo_stack:
+        u1, u2 = st.columns(2)
+        with u1:
+            if journal.undo_stack and st.button(
+                f"↩️ Undo: {journal.undo_stack[-1].label}", type="primary", key="btn_undo"
+            ):
+                report_conflicts(journal.undo(store))
+                st.rerun()
+        with u2:
+            if journal.redo_stack and st.button(
+                f"↪️ Redo: {journal.redo_stack[-1].label}", key="btn_redo"
+            ):
+                report_conflicts(journal.redo(store))
+                st.rerun()
 
     op_tab1, op_tab2, op_tab3 = st.tabs(
         ["➕ Add Single Entry", "📂 Import Excel", "📤 Export / Snapshots"]
@@ -398,19 +2313,60 @@ with st.expander("🛠️ Data Management (Import / Add / Undo / Export)", expan
         with col1:
             st.info("Step 2: Upload Data")
             uploaded_file = st.file_uploader("Upload Excel File", type=["xlsx", "xls"])
+            import_mode = st.radio(
+                "Import mode",
+                ["Replace all data", "Update by MASON CODE"],
+                key="import_mode",
+                horizontal=True,
+                help="Update merges the file into existing masons by MASON CODE, keeping "
+                     "their visit and registration history, and adds the rest as new rows. "
+                     "Blank cells and invalid contact numbers in the file keep the existing "
+                     "values; write NO in a HW column to clear it.",
+            )
             if uploaded_file is not None:
                 if st.button("Load Data"):
-                    new_data = load_excel_data(uploaded_file)
+                    upsert = import_mode == "Update by MASON CODE" and "MASON CODE" in store.df.columns
+                    new_data = load_excel_data(uploaded_file, key_column="MASON CODE" if upsert else None)
                     if new_data is not None:
-                        save_state_for_undo()
-                        st.session_state["data"] = new_data
-                        for col in ["Visited_Status", "Visited_At", "Registered_Status", "Registered_At"]:
-                            if col not in st.session_state["data"].columns:
-                                st.session_state["data"][col] = ""
-                        write_sheet(st.session_state["data"].copy(), GOOGLE_SHEET_ID, SHEET_TAB_NAME)
-                        st.success(f"Loaded {len(new_data)} rows and saved to {DATA_FILE}!")
+                        if upsert:
+                            base_version, master = store.snapshot()
+                            changes = upsert_frames("Import Excel (update)", master, new_data, store.allocate_snos)
+                            done, conflicts = changes.apply(store, base_version)
+                            journal.record(done)
+                            report_conflicts(conflicts)
+                            updated = done.cells["S.NO"].nunique()
+                            st.session_state["import_notes"].insert(
+                                0, f"Updated {updated:,} masons and added {len(changes.added):,} new ones."
+                            )
+                            touched = set(done.cells["S.NO"]) | set(done.added["S.NO"].tolist())
+                            duplicates = store.duplicate_report(touched)
+                        else:
+                            old_data = store.df
+                            store.commit(new_data, full=True)
+                            journal.record(diff_frames("Import Excel", old_data, new_data))
+                            st.session_state["import_notes"].insert(
+                                0, f"Loaded {len(new_data):,} rows and saved to {DATA_FILE}!"
+                            )
+                            duplicates = store.duplicate_report()
+                        if len(duplicates):
+                            st.session_state["import_notes"].append(
+                                f"{duplicates['S.NO'].nunique():,} masons share a MASON CODE or CONTACT "
+                                "NUMBER with another row; see the duplicate report below."
+                            )
+                            st.session_state["import_duplicates"] = duplicates
                         st.rerun()
 
+            # Outcome of the last import, kept across its rerun
+            notes = st.session_state.pop("import_notes", None)
+            if notes:
+                st.success(notes[0])
+                for note in notes[1:]:
+                    st.warning(note)
+            duplicates = st.session_state.pop("import_duplicates", None)
+            if duplicates is not None:
+                with st.expander(f"Duplicate report ({len(duplicates):,} rows)"):
+                    st.dataframe(duplicates, hide_index=True)
+
     # --- EXPORT / SNAPSHOTS TAB ---
     with op_tab3:
         st.subheader("Export & Monthly Snapshots")
@@ -419,9 +2375,10 @@ with st.expander("🛠️ Data Management (Import / Add / Undo / Export)", expan
         st.markdown("**Download current full dataset**")
         st.download_button(
             "📥 Download Current Data",
-            to_excel(st.session_state["data"]),
+            current_export,
             file_name=f"mason_data_{datetime.now().strftime('%Y-%m-%d_%H%M')}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore",
         )
 
         st.markdown("---")
@@ -429,36 +2386,36 @@ with st.expander("🛠️ Data Management (Import / Add / Undo / Export)", expan
         # 2) Save / overwrite this month's snapshot to disk (manual trigger)
         st.markdown("**Save / update this month's snapshot (manual)**")
         st.caption(
-            "This saves the current data as `mason_data_YYYY-MM.xlsx` inside the `mason_snapshots` folder. "
+            "This saves the current data as this month's snapshot in the `mason_snapshots` folder. "
             "Note: the app also auto-saves & clears visit/register columns on the last day of each month."
         )
 
         if st.button("💾 Save This Month Snapshot", key="btn_save_snapshot_manual"):
             month_key_now = datetime.now().strftime("%Y-%m")
-            snapshot_path = save_month_snapshot(st.session_state["data"], month_key=month_key_now)
-            st.success(f"Snapshot saved as: {snapshot_path.name}")
+            saved_month = save_month_snapshot(store.df, month_key=month_key_now)
+            st.success(f"Snapshot saved for {saved_month}")
 
         st.markdown("---")
 
         # 3) Dropdown of existing monthly snapshot files with single download button
         st.markdown("**Download a monthly snapshot**")
 
-        snapshot_files = sorted(SNAPSHOT_DIR.glob("mason_data_*.xlsx"), reverse=True)
-        if not snapshot_files:
+        snapshots = load_snapshot_manifest()
+        if not snapshots:
             st.caption("No snapshots saved yet.")
         else:
-            month_options = [f.stem.replace("mason_data_", "") for f in snapshot_files]
+            month_options = sorted(snapshots, reverse=True)
             selected_month = st.selectbox("Select month", month_options, key="snapshot_month_select")
-            chosen_path = snapshot_files[month_options.index(selected_month)]
-
-            with open(chosen_path, "rb") as fh:
-                st.download_button(
-                    label=f"📅 Download {selected_month} snapshot",
-                    data=fh.read(),
-                    file_name=chosen_path.name,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    key=f"dl_snapshot_{selected_month}",
-                )
+            saved_at = snapshots[selected_month]["saved_at"]
+
+            st.download_button(
+                label=f"📅 Download {selected_month} snapshot",
+                data=lambda: snapshot_excel(selected_month, saved_at),
+                file_name=f"mason_data_{selected_month}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"dl_snapshot_{selected_month}",
+                on_click="ignore",
+            )
 
     # --- ADD ENTRY TAB ---
     with op_tab1:
@@ -503,17 +2460,17 @@ with st.expander("🛠️ Data Management (Import / Add / Undo / Export)", expan
                 hw310 = st.checkbox("HW310", key="form_hw310")
 
             other_notes = st.text_input("Other / Remarks", key="form_other")
+            allow_duplicate = st.checkbox(
+                "Add even if the Mason Code or Contact Number is already in use",
+                key="form_allow_duplicate",
+            )
             submitted = st.form_submit_button("Add Line Item")
 
             if submitted:
                 if not mason_name:
                     st.error("Mason Name is required!")
                 else:
-                    save_state_for_undo()
-                    if "S.NO" in st.session_state["data"].columns and not st.session_state["data"].empty:
-                        new_sno = st.session_state["data"]["S.NO"].max() + 1
-                    else:
-                        new_sno = 1
+                    new_sno = store.allocate_snos()
 
                     new_row = {
                         "S.NO": new_sno,
@@ -524,27 +2481,35 @@ with st.expander("🛠️ Data Management (Import / Add / Undo / Export)", expan
                         "Location": location,
                         "DAY": day,
                         "Category": category,
-                        "HW305": "YES" if hw305 else "",
-                        "HW101": "YES" if hw101 else "",
-                        "Hw201": "YES" if hw201 else "",
-                        "HW103": "YES" if hw103 else "",
-                        "HW302": "YES" if hw302 else "",
-                        "HW310": "YES" if hw310 else "",
+                        "HW305": hw305,
+                        "HW101": hw101,
+                        "Hw201": hw201,
+                        "HW103": hw103,
+                        "HW302": hw302,
+                        "HW310": hw310,
                         "other": other_notes,
-                        "Visited_Status": "",
-                        "Visited_At": "",
-                        "Registered_Status": "",
-                        "Registered_At": "",
+                        "Visited_Status": False,
+                        "Visited_At": None,
+                        "Registered_Status": False,
+                        "Registered_At": None,
                     }
 
-                    st.session_state["data"] = pd.concat(
-                        [st.session_state["data"], pd.DataFrame([new_row])],
-                        ignore_index=True,
-                    )
-                    write_sheet(st.session_state["data"].copy(), GOOGLE_SHEET_ID, SHEET_TAB_NAME)
-
-                    st.success("Entry added & saved!")
-                    st.rerun()
+                    if allow_duplicate:
+                        added, duplicates = store.append_row(new_row), {}
+                    else:
+                        added, duplicates = store.append_unique(new_row)
+                    if duplicates:
+                        st.error("Not added, this mason may already exist:\n" + "\n".join(
+                            f"- {col} already used by "
+                            + ", ".join(f"#{sno} {store.row(sno)['MASON NAME']}" for sno in snos)
+                            for col, snos in duplicates.items()
+                        ))
+                    else:
+                        journal.record(JournalEntry(f"Add #{new_sno}", added=added))
+                        if allow_duplicate:
+                            report_duplicates([new_sno])
+                        st.success("Entry added & saved!")
+                        st.rerun()
 
         # col2 defined in Import tab block above
         with col2:
@@ -559,7 +2524,7 @@ with st.expander("🛠️ Data Management (Import / Add / Undo / Export)", expan
 # ------------ FILTERS + METRICS SECTION ------------
 
 with st.expander("Filters", expanded=True):
-    base_df = st.session_state["data"].copy()
+    cascade = cascade_options(*store.snapshot())
 
     # --- HEADER ROW: title + reset link ---
     h1, h2 = st.columns([3, 1])
@@ -580,13 +2545,8 @@ with st.expander("Filters", expanded=True):
     # --- FIRST ROW: Location, DLR, Day, Category (cascade) ---
     fc1, fc2, fc3, fc4 = st.columns(4)
 
-    # DAY options (for cascading)
-    days_list = [
-        str(x).strip()
-        for x in base_df.get("DAY", "").unique()
-        if str(x).strip()
-    ]
-    all_days = ["All"] + sorted(set(days_list))
+    # Options for each level come from the cached cascade, keyed by the levels above
+    all_days = cascade["days"]
 
     with fc3:
         st.markdown('<div class="mde-label"><span class="icon">📅</span>Day</div>', unsafe_allow_html=True)
@@ -596,18 +2556,8 @@ with st.expander("Filters", expanded=True):
             key="filter_day",
         )
 
-    # dataframe limited by day (for next cascades)
-    df_after_day = base_df.copy()
-    if selected_day != "All":
-        df_after_day = df_after_day[df_after_day["DAY"] == selected_day]
-
     # LOCATION options depend on day
-    locs = [
-        str(x).strip()
-        for x in df_after_day.get("Location", "").unique()
-        if str(x).strip()
-    ]
-    all_locs = ["All"] + sorted(set(locs))
+    all_locs = cascade["locations"].get(selected_day, ["All"])
 
     with fc1:
         st.markdown('<div class="mde-label"><span class="icon">📍</span>Location</div>', unsafe_allow_html=True)
@@ -617,18 +2567,8 @@ with st.expander("Filters", expanded=True):
             key="filter_location",
         )
 
-    # dataframe limited by day + location
-    df_after_loc = df_after_day.copy()
-    if selected_location != "All":
-        df_after_loc = df_after_loc[df_after_loc["Location"] == selected_location]
-
     # DLR options depend on day + location
-    dlrs_raw = [
-        str(x).strip()
-        for x in df_after_loc.get("DLR NAME", "").unique()
-        if str(x).strip()
-    ]
-    all_dlrs = ["All"] + sorted(set(dlrs_raw))
+    all_dlrs = cascade["dlrs"].get((selected_day, selected_location), ["All"])
 
     with fc2:
         st.markdown('<div class="mde-label"><span class="icon">🏪</span>DLR Name</div>', unsafe_allow_html=True)
@@ -638,22 +2578,9 @@ with st.expander("Filters", expanded=True):
             key="filter_dlr",
         )
 
-    # dataframe limited by day + location + dlr (for Category options)
-    df_for_category = df_after_loc.copy()
-    if selected_dlr != "All":
-        df_for_category = df_for_category[df_for_category["DLR NAME"] == selected_dlr]
-
     with fc4:
         st.markdown('<div class="mde-label"><span class="icon">🏷️</span>Category</div>', unsafe_allow_html=True)
-        cats_raw = [
-            str(x).strip()
-            for x in df_for_category.get("Category", "").unique()
-            if str(x).strip() != ""
-        ]
-        cats = ["All"] + sorted(set(cats_raw))
-        has_blank = (df_for_category.get("Category", "") == "").any()
-        if has_blank:
-            cats.append("Blank / Uncategorized")
+        cats = cascade["categories"].get((selected_day, selected_location, selected_dlr), ["All"])
 
         selected_cat = st.selectbox(
             "",
@@ -675,6 +2602,14 @@ with st.expander("Filters", expanded=True):
             "No Products",
             key="filter_no_products",
         )
+    with pvc3:
+        st.markdown('<div class="mde-label"><span class="icon">🧩</span>Interested in all of</div>', unsafe_allow_html=True)
+        st.multiselect(
+            "",
+            HW_COLUMNS,
+            key="filter_products_all",
+            placeholder="Any products",
+        )
 
     # --- THIRD ROW: Visited / Registered ---
     vc1, vc2 = st.columns(2)
@@ -693,96 +2628,79 @@ with st.expander("Filters", expanded=True):
             key="filter_reg_status",
         )
 
-    # --- FOURTH ROW: Mobile search + button ---
-    mc1, mc2 = st.columns([3, 1])
-    with mc1:
-        st.markdown('<div class="mde-label"><span class="icon">📱</span>Search by Mobile Number</div>', unsafe_allow_html=True)
-        st.session_state["filter_mobile_input"] = st.text_input(
-            "",
-            value=st.session_state.get("filter_mobile_input", ""),
-            placeholder="Enter full or partial number...",
-        )
-    with mc2:
-        st.markdown("&nbsp;", unsafe_allow_html=True)
-        if st.button("Search", key="btn_mobile_search"):
-            st.session_state["filter_mobile_query"] = st.session_state["filter_mobile_input"].strip()
-            st.rerun()
+    # --- FOURTH ROW: Mobile search (updates as you type) ---
+    st.markdown('<div class="mde-label"><span class="icon">📱</span>Search by Mobile Number</div>', unsafe_allow_html=True)
+    st.text_input(
+        "",
+        key="filter_mobile_input",
+        placeholder="Enter full or partial number...",
+        live=True,
+    )
 
 # ------------ APPLY FILTERS USING NEW FIELDS ------------
 
-df_display = st.session_state["data"].copy()
+def filter_conditions() -> list[tuple[str, object]]:
+    """The filter widgets' selections as (column, value) conditions for the index."""
+    # Every filter is an equality test answered by the bitmap index
+    conditions = []
 
-if not df_display.empty:
     # Day
     selected_day = st.session_state.get("filter_day", "All")
     if selected_day != "All":
-        df_display = df_display[df_display["DAY"] == selected_day]
+        conditions.append(("DAY", selected_day))
 
     # Location
     selected_location = st.session_state.get("filter_location", "All")
     if selected_location != "All":
-        df_display = df_display[df_display["Location"] == selected_location]
+        conditions.append(("Location", selected_location))
 
     # DLR
     selected_dlr = st.session_state.get("filter_dlr", "All")
     if selected_dlr != "All":
-        df_display = df_display[df_display["DLR NAME"] == selected_dlr]
+        conditions.append(("DLR NAME", selected_dlr))
 
     # Category
     selected_cat = st.session_state.get("filter_cat", "All")
     if selected_cat == "Blank / Uncategorized":
-        df_display = df_display[
-            df_display["Category"].isna() | (df_display["Category"] == "")
-        ]
+        conditions.append(("Category", ""))
     elif selected_cat != "All":
-        df_display = df_display[df_display["Category"] == selected_cat]
+        conditions.append(("Category", selected_cat))
 
     # Visited
     visit_filter = st.session_state.get("filter_visit_status", "All")
-    if "Visited_Status" in df_display.columns:
-        if visit_filter == "Visited":
-            df_display = df_display[df_display["Visited_Status"] == "Visited"]
-        elif visit_filter == "Not Visited":
-            df_display = df_display[
-                (df_display["Visited_Status"].isna()) |
-                (df_display["Visited_Status"] == "")
-            ]
+    if visit_filter != "All":
+        conditions.append(("Visited_Status", visit_filter == "Visited"))
 
     # Registered
     reg_filter = st.session_state.get("filter_reg_status", "All")
-    if "Registered_Status" in df_display.columns:
-        if reg_filter == "Registered":
-            df_display = df_display[df_display["Registered_Status"] == "Registered"]
-        elif reg_filter == "Not Registered":
-            df_display = df_display[
-                (df_display["Registered_Status"].isna()) |
-                (df_display["Registered_Status"] == "")
-            ]
+    if reg_filter != "All":
+        conditions.append(("Registered_Status", reg_filter == "Registered"))
 
     # Products
-    hw_cols = ["HW305", "HW101", "Hw201", "HW103", "HW302", "HW310"]
-    show_only_products = st.session_state.get("filter_only_products", False)
-    show_no_products = st.session_state.get("filter_no_products", False)
+    if st.session_state.get("filter_only_products", False):
+        conditions.append(("has_product", True))
+    if st.session_state.get("filter_no_products", False):
+        conditions.append(("has_product", False))
+    wanted = st.session_state.get("filter_products_all", [])
+    if wanted:
+        conditions.append(("products", sum(1 << HW_COLUMNS.index(p) for p in wanted)))
 
-    if show_only_products:
-        mask = df_display[hw_cols].apply(
-            lambda x: x.astype(str).str.contains("YES", case=False).any(), axis=1
-        )
-        df_display = df_display[mask]
+    # Mobile search: digits only, matched through the contact n-gram index
+    mobile_query = st.session_state.get("filter_mobile_input", "").strip()
+    if mobile_query:
+        conditions.append(("contact", re.sub(r"\D", "", mobile_query)))
 
-    if show_no_products:
-        mask = df_display[hw_cols].apply(
-            lambda x: not x.astype(str).str.contains("YES", case=False).any(), axis=1
-        )
-        df_display = df_display[mask]
+    return conditions
+
+
+def filtered_rows() -> pd.DataFrame:
+    """Rows of the current master matching the filters in session state."""
+    if store.df.empty:
+        return store.df
+    return store.select(filter_conditions())
 
-    # Mobile search
-    mobile_query = st.session_state.get("filter_mobile_query", "")
-    if mobile_query and "CONTACT NUMBER" in df_display.columns:
-        contact_str = df_display["CONTACT NUMBER"].astype(str).str.replace(".0", "", regex=False)
-        df_display = df_display[
-            contact_str.str.contains(mobile_query, case=False, na=False)
-        ]
+
+df_display = filtered_rows()
 
 # ------------ METRICS (HTML-STYLE KPIs) ------------
 
@@ -794,255 +2712,463 @@ intro_text = (
 )
 st.markdown(intro_text)
 
-k1, k2, k3, k4 = st.columns(4)
 
-with k1:
-    st.metric("TOTAL MASONS", len(st.session_state["data"]))
+@st.fragment(key="kpis")
+def render_kpis():
+    """The KPI row. Card status toggles rerun just this and the card."""
+    agg = store.aggregates(filter_conditions())
 
-with k2:
-    st.metric("DISPLAYING", len(df_display))
+    k1, k2, k3, k4, k5, k6 = st.columns(6)
 
-with k3:
-    st.metric(
-        "LOCATIONS",
-        df_display["Location"].nunique() if "Location" in df_display.columns else 0,
-    )
+    with k1:
+        st.metric("TOTAL MASONS", len(store.df))
+
+    with k2:
+        st.metric("DISPLAYING", agg.rows)
+
+    with k3:
+        st.metric("LOCATIONS", agg.distinct("Location"))
+
+    with k4:
+        st.metric("DLRS", agg.distinct("DLR NAME"))
+
+    with k5:
+        st.metric("VISITED", agg.visited)
+
+    with k6:
+        st.metric("REGISTERED", agg.registered)
 
-with k4:
-    st.metric(
-        "DLRS",
-        df_display["DLR NAME"].nunique() if "DLR NAME" in df_display.columns else 0,
-    )
+
+render_kpis()
 
 st.divider()
 
-# ------------ MAIN TABS ------------
+# ------------ CARD ACTIONS ------------
 
-tab_cards, tab_graphs, tab_data = st.tabs(
-    ["📇 Mason Cards", "📈 Analytics", "📝 Data Editor"]
-)
+STATUS_FILTER_KEYS = {
+    "Visited_Status": "filter_visit_status",
+    "Registered_Status": "filter_reg_status",
+}
 
-# ==========================================
-#   EDITABLE CARDS SECTION (PAGINATED)
-# ==========================================
-with tab_cards:
-    st.subheader("Mason Directory")
-    st.info("💡 **Tip:** Click a card to expand. Any change you make inside is **saved automatically**.")
 
-    if df_display.empty:
-        st.warning("No records found matching filters.")
+def toggle_status(sno: int, status_col: str, date_col: str, shown: bool):
+    """
+    Flip a card's Visited/Registered status from the `shown` state, then
+    rerun only what it affects. If someone else already flipped it, the
+    card is just refreshed instead of flipping it back.
+    """
+    new_status = not shown
+    store.fresh.wait()
+    with store.lock:
+        changes, _ = store.compare_and_set([(sno, status_col, shown, new_status)])
+        if changes:
+            changes += store.set_cells(sno, {
+                date_col: pd.Timestamp.now().normalize() if new_status else pd.NaT,
+            })
+    if not changes:
+        st.rerun()
+    action = "Mark" if new_status else "Unmark"
+    st.session_state["journal"].record(
+        JournalEntry(f"{action} #{sno} {STATUS_LABELS[status_col]}", changes)
+    )
+    if st.session_state.get(STATUS_FILTER_KEYS[status_col], "All") != "All":
+        # The card may no longer match the filters, so the list itself changes
+        st.rerun()
+    st.rerun([f"card_{sno}", "kpis"])
+
+
+def remember_card_open(sno: int):
+    """Track open cards so one stays open when its header label changes."""
+    open_cards = st.session_state.setdefault("open_cards", set())
+    if st.session_state[f"card_open_{sno}"]:
+        open_cards.add(sno)
     else:
-        # ---------- PAGINATION CONTROLS ----------
-        total_cards = len(df_display)
-
-        c1, c2, c3 = st.columns([1, 1, 3])
-        with c1:
-            page_size = st.selectbox(
-                "Cards per page",
-                [10, 20, 50],
-                index=1,
-                key="cards_page_size",
-            )
-        total_pages = max(1, math.ceil(total_cards / page_size))
-
-        with c2:
-            current_page = st.number_input(
-                "Page",
-                min_value=1,
-                max_value=total_pages,
-                value=min(st.session_state.get("cards_page", 1), total_pages),
-                step=1,
-                key="cards_page",
+        open_cards.discard(sno)
+
+
+def render_card(sno: int):
+    """One mason card, read fresh from the shared dataset on every (re)run."""
+    row = store.row(sno)
+    if row is None:
+        return
+
+    # Header visuals
+    name = row.get("MASON NAME", "Unknown")
+    code = row.get("MASON CODE", "")
+    loc = row.get("Location", "")
+    contact = format_contact(row.get("CONTACT NUMBER"))
+
+    is_visited = bool(row.get("Visited_Status"))
+    is_registered = bool(row.get("Registered_Status"))
+
+    status_badges = ""
+    if is_visited:
+        status_badges += "🧭Visited |"
+    if is_registered:
+        status_badges += "✅Registered |"
+
+    card_label = f"{status_badges} **{name}** "
+    if code:
+        card_label += f"({code}) "
+    if loc:
+        card_label += f" | 📍 {loc}"
+    if contact:
+        card_label += f" | 📞 {contact}"
+
+    open_cards = st.session_state.setdefault("open_cards", set())
+    card = st.expander(
+        card_label,
+        expanded=sno in open_cards,
+        key=f"card_open_{sno}",
+        on_change=remember_card_open,
+        args=(sno,),
+    )
+    # Collapsed cards send only their header; the body is built on opening
+    if card.open:
+        with card:
+            render_card_body(sno, row)
+
+
+def render_card_body(sno: int, row: pd.Series):
+    """The editable fields and actions of an opened card."""
+    name = row.get("MASON NAME", "Unknown")
+    code = row.get("MASON CODE", "")
+    loc = row.get("Location", "")
+    contact = format_contact(row.get("CONTACT NUMBER"))
+    is_visited = bool(row.get("Visited_Status"))
+    is_registered = bool(row.get("Registered_Status"))
+
+    # When the row changed since this card last rendered (here or in another
+    # session), drop the kept widget values so the fields show the new ones
+    version = store.row_versions.get(sno)
+    if st.session_state.get(f"seen_{sno}", version) != version:
+        for prefix in ["name", "code", "cont", "loc", "dlr", "day", "cat", "other"] + HW_COLUMNS:
+            st.session_state.pop(f"{prefix}_{sno}", None)
+    st.session_state[f"seen_{sno}"] = version
+
+    def shown(key: str, value):
+        """What a widget displays: its kept state if any, else the row value."""
+        return st.session_state.get(key, value)
+
+    # 1. PRIMARY DETAILS
+    st.markdown("#### 👤 Personal Details")
+    c1, c2, c3 = st.columns(3)
+
+    with c1:
+        st.text_input(
+            "Mason Name",
+            value=name,
+            key=f"name_{sno}",
+            on_change=update_entry,
+            args=(sno, "MASON NAME", f"name_{sno}"),
+            kwargs={"shown": shown(f"name_{sno}", name)},
+        )
+    with c2:
+        st.text_input(
+            "Mason Code",
+            value=code,
+            key=f"code_{sno}",
+            on_change=update_entry,
+            args=(sno, "MASON CODE", f"code_{sno}"),
+            kwargs={"shown": shown(f"code_{sno}", code)},
+        )
+    with c3:
+        st.text_input(
+            "Contact Number",
+            value=contact,
+            key=f"cont_{sno}",
+            on_change=update_entry,
+            args=(sno, "CONTACT NUMBER", f"cont_{sno}"),
+            kwargs={"shown": shown(f"cont_{sno}", contact)},
+        )
+
+    # 2. LOCATION & META
+    st.markdown("#### 📍 Location & Classification")
+    l1, l2, l3, l4 = st.columns(4)
+    with l1:
+        st.text_input(
+            "Location", value=loc, key=f"loc_{sno}",
+            on_change=update_entry, args=(sno, "Location", f"loc_{sno}"),
+            kwargs={"shown": shown(f"loc_{sno}", loc)},
+        )
+    with l2:
+        st.text_input(
+            "DLR Name", value=row.get("DLR NAME", ""), key=f"dlr_{sno}",
+            on_change=update_entry, args=(sno, "DLR NAME", f"dlr_{sno}"),
+            kwargs={"shown": shown(f"dlr_{sno}", row.get("DLR NAME", ""))},
+        )
+    with l3:
+        st.text_input(
+            "Day", value=row.get("DAY", ""), key=f"day_{sno}",
+            on_change=update_entry, args=(sno, "DAY", f"day_{sno}"),
+            kwargs={"shown": shown(f"day_{sno}", row.get("DAY", ""))},
+        )
+    with l4:
+        current_cat = row.get("Category", "")
+        current_cat = "" if pd.isna(current_cat) else str(current_cat)
+        # A category outside the usual ones (from an import) is offered as is,
+        # so the widget shows, and compares against, the row's real value
+        options = CATEGORY_OPTIONS if current_cat in CATEGORY_OPTIONS else CATEGORY_OPTIONS + [current_cat]
+        idx = options.index(current_cat)
+        st.selectbox(
+            "Category", options,
+            index=idx,
+            key=f"cat_{sno}",
+            on_change=update_entry, args=(sno, "Category", f"cat_{sno}"),
+            kwargs={"shown": shown(f"cat_{sno}", options[idx])},
+        )
+
+    # 3. PRODUCTS
+    st.markdown("#### 📦 Products Interested")
+    p_cols = st.columns(6)
+    hw_list = ["HW305", "HW101", "Hw201", "HW103", "HW302", "HW310"]
+
+    for i, prod in enumerate(hw_list):
+        with p_cols[i]:
+            st.checkbox(
+                prod,
+                value=bool(row.get(prod, False)),
+                key=f"{prod}_{sno}",
+                on_change=update_entry,
+                args=(sno, prod, f"{prod}_{sno}", True),  # checkbox logic
+                kwargs={"shown": shown(f"{prod}_{sno}", bool(row.get(prod, False)))},
             )
 
-        start_idx = (current_page - 1) * page_size
-        end_idx = start_idx + page_size
-        df_page = df_display.iloc[start_idx:end_idx]
+    # 4. REMARKS / OTHER
+    st.markdown("#### 📝 Remarks")
+    st.text_area(
+        "Other Notes",
+        value=row.get("other", ""),
+        height=68,
+        key=f"other_{sno}",
+        on_change=update_entry,
+        args=(sno, "other", f"other_{sno}"),
+        kwargs={"shown": shown(f"other_{sno}", row.get("other", ""))},
+    )
+
+    st.markdown("---")
+
+    # 5. ACTION BUTTONS
+    b1, b2, b3 = st.columns([1, 1, 1])
 
-        with c3:
+    with b1:
+        if contact and len(contact) > 5:
+            # More than ten digits means the number was stored with its country code
+            dial = f"+{contact}" if len(contact) > 10 else contact
             st.markdown(
-                f"<div style='margin-top:1.7rem;font-size:0.85rem;color:#6b7280;'>"
-                f"Showing <b>{start_idx + 1}</b> – <b>{min(end_idx, total_cards)}</b> of <b>{total_cards}</b> records"
-                f"</div>",
-                unsafe_allow_html=True,
+                f"""<a href="tel:{dial}" style="display:block;text-align:center;background:#166534;color:white;padding:8px;border-radius:5px;text-decoration:none;">📞 Call Now</a>""",
+                unsafe_allow_html=True
             )
+        else:
+            st.caption("🚫 No valid number")
+
+    with b2:
+        v_label = "✅ Visited" if is_visited else "Mark Visited"
+        v_type = "primary" if is_visited else "secondary"
+        st.button(
+            v_label, key=f"btn_vis_{sno}", type=v_type, use_container_width=True,
+            on_click=toggle_status, args=(sno, "Visited_Status", "Visited_At", is_visited),
+        )
 
-        st.markdown("---")
+    with b3:
+        r_label = "✅ Registered" if is_registered else "Mark Registered"
+        r_type = "primary" if is_registered else "secondary"
+        st.button(
+            r_label, key=f"btn_reg_{sno}", type=r_type, use_container_width=True,
+            on_click=toggle_status, args=(sno, "Registered_Status", "Registered_At", is_registered),
+        )
 
-        # ---------- RENDER ONLY CURRENT PAGE CARDS ----------
-        for index, row in df_page.iterrows():
-            sno = int(row["S.NO"]) if "S.NO" in row else index
-
-            # Header visuals
-            name = row.get("MASON NAME", "Unknown")
-            code = row.get("MASON CODE", "")
-            loc = row.get("Location", "")
-            contact = str(row.get("CONTACT NUMBER", "")).replace(".0", "")
-
-            is_visited = row.get("Visited_Status") == "Visited"
-            is_registered = row.get("Registered_Status") == "Registered"
-
-            status_badges = ""
-            if is_visited:
-                status_badges += "🧭Visited |"
-            if is_registered:
-                status_badges += "✅Registered |"
-
-            card_label = f"{status_badges} **{name}** "
-            if code:
-                card_label += f"({code}) "
-            if loc:
-                card_label += f" | 📍 {loc}"
-            if contact:
-                card_label += f" | 📞 {contact}"
-
-            with st.expander(card_label, expanded=False):
-
-                # 1. PRIMARY DETAILS
-                st.markdown("#### 👤 Personal Details")
-                c1, c2, c3 = st.columns(3)
-
-                with c1:
-                    st.text_input(
-                        "Mason Name",
-                        value=name,
-                        key=f"name_{sno}",
-                        on_change=update_entry,
-                        args=(sno, "MASON NAME", f"name_{sno}")
-                    )
-                with c2:
-                    st.text_input(
-                        "Mason Code",
-                        value=code,
-                        key=f"code_{sno}",
-                        on_change=update_entry,
-                        args=(sno, "MASON CODE", f"code_{sno}")
-                    )
-                with c3:
-                    st.text_input(
-                        "Contact Number",
-                        value=contact,
-                        key=f"cont_{sno}",
-                        on_change=update_entry,
-                        args=(sno, "CONTACT NUMBER", f"cont_{sno}")
-                    )
-
-                # 2. LOCATION & META
-                st.markdown("#### 📍 Location & Classification")
-                l1, l2, l3, l4 = st.columns(4)
-                with l1:
-                    st.text_input(
-                        "Location", value=loc, key=f"loc_{sno}",
-                        on_change=update_entry, args=(sno, "Location", f"loc_{sno}")
-                    )
-                with l2:
-                    st.text_input(
-                        "DLR Name", value=row.get("DLR NAME", ""), key=f"dlr_{sno}",
-                        on_change=update_entry, args=(sno, "DLR NAME", f"dlr_{sno}")
-                    )
-                with l3:
-                    st.text_input(
-                        "Day", value=row.get("DAY", ""), key=f"day_{sno}",
-                        on_change=update_entry, args=(sno, "DAY", f"day_{sno}")
-                    )
-                with l4:
-                    current_cat = row.get("Category", "")
-                    options = ["E", "M", "Other", ""]
-                    try:
-                        idx = options.index(current_cat) if current_cat in options else 3
-                    except ValueError:
-                        idx = 3
-                    st.selectbox(
-                        "Category", options,
-                        index=idx,
-                        key=f"cat_{sno}",
-                        on_change=update_entry, args=(sno, "Category", f"cat_{sno}")
-                    )
-
-                # 3. PRODUCTS
-                st.markdown("#### 📦 Products Interested")
-                p_cols = st.columns(6)
-                hw_list = ["HW305", "HW101", "Hw201", "HW103", "HW302", "HW310"]
-
-                for i, prod in enumerate(hw_list):
-                    val_str = str(row.get(prod, "")).upper()
-                    is_checked = "YES" in val_str
-                    with p_cols[i]:
-                        st.checkbox(
-                            prod,
-                            value=is_checked,
-                            key=f"{prod}_{sno}",
-                            on_change=update_entry,
-                            args=(sno, prod, f"{prod}_{sno}", True)  # checkbox logic
-                        )
-
-                # 4. REMARKS / OTHER
-                st.markdown("#### 📝 Remarks")
-                st.text_area(
-                    "Other Notes",
-                    value=row.get("other", ""),
-                    height=68,
-                    key=f"other_{sno}",
-                    on_change=update_entry,
-                    args=(sno, "other", f"other_{sno}")
-                )
 
-                st.markdown("---")
+# Most masons listed by name in the bulk picker; larger sets use "all displayed"
+BULK_PICK_LIMIT = 1000
+CATEGORY_OPTIONS = ["E", "M", "Other", ""]
 
-                # 5. ACTION BUTTONS
-                b1, b2, b3 = st.columns([1, 1, 1])
+def bulk_targets() -> pd.DataFrame:
+    """The displayed rows the bulk actions apply to."""
+    rows = filtered_rows()
+    if st.session_state.get("bulk_all", False):
+        return rows
+    return rows[rows["S.NO"].isin(st.session_state.get("bulk_snos", []))]
 
-                with b1:
-                    if contact and len(contact) > 5:
-                        st.markdown(
-                            f"""<a href="tel:{contact}" style="display:block;text-align:center;background:#166534;color:white;padding:8px;border-radius:5px;text-decoration:none;">📞 Call Now</a>""",
-                            unsafe_allow_html=True
-                        )
-                    else:
-                        st.caption("🚫 No valid number")
-
-                with b2:
-                    v_label = "✅ Visited" if is_visited else "Mark Visited"
-                    v_type = "primary" if is_visited else "secondary"
-                    if st.button(v_label, key=f"btn_vis_{sno}", type=v_type, use_container_width=True):
-                        new_status = "" if is_visited else "Visited"
-                        st.session_state["data"].loc[st.session_state["data"]["S.NO"] == sno, "Visited_Status"] = new_status
-                        st.session_state["data"].loc[st.session_state["data"]["S.NO"] == sno, "Visited_At"] = (
-                            datetime.now().strftime("%Y-%m-%d") if new_status else ""
-                        )
-                        write_sheet(st.session_state["data"].copy(), GOOGLE_SHEET_ID, SHEET_TAB_NAME)
-                        st.rerun()
 
-                with b3:
-                    r_label = "✅ Registered" if is_registered else "Mark Registered"
-                    r_type = "primary" if is_registered else "secondary"
-                    if st.button(r_label, key=f"btn_reg_{sno}", type=r_type, use_container_width=True):
-                        new_status = "" if is_registered else "Registered"
-                        st.session_state["data"].loc[st.session_state["data"]["S.NO"] == sno, "Registered_Status"] = new_status
-                        st.session_state["data"].loc[st.session_state["data"]["S.NO"] == sno, "Registered_At"] = (
-                            datetime.now().strftime("%Y-%m-%d") if new_status else ""
-                        )
-                        write_sheet(st.session_state["data"].copy(), GOOGLE_SHEET_ID, SHEET_TAB_NAME)
-                        st.rerun()
+def apply_bulk(label: str, cells: list[tuple]):
+    """One update_cells call for every selected row: one in-memory pass, one sheet write."""
+    changes = store.update_cells(cells)
+    st.session_state["journal"].record(JournalEntry(label, changes))
+    st.session_state["bulk_snos"] = []
+    st.toast(label)
+
+
+def bulk_mark(status_col: str, date_col: str):
+    rows = bulk_targets()
+    # Already-marked rows keep their original date
+    snos = rows.loc[~rows[status_col].astype(bool), "S.NO"].tolist()
+    today = pd.Timestamp.now().normalize()
+    apply_bulk(
+        f"Mark {len(snos):,} {STATUS_LABELS[status_col]}",
+        [(sno, status_col, True) for sno in snos] + [(sno, date_col, today) for sno in snos],
+    )
+
+
+def bulk_clear():
+    snos = bulk_targets()["S.NO"].tolist()
+    cleared = {"Visited_Status": False, "Visited_At": pd.NaT,
+               "Registered_Status": False, "Registered_At": pd.NaT}
+    apply_bulk(
+        f"Clear status of {len(snos):,}",
+        [(sno, col, val) for col, val in cleared.items() for sno in snos],
+    )
+
+
+def bulk_set_category():
+    category = st.session_state.get("bulk_category", "")
+    snos = bulk_targets()["S.NO"].tolist()
+    apply_bulk(
+        f"Set Category of {len(snos):,} to {category or 'blank'}",
+        [(sno, "Category", category) for sno in snos],
+    )
+
+
+def render_bulk_actions(df_display: pd.DataFrame):
+    """Status and category actions applied to many displayed masons at once."""
+    with st.expander("⚡ Bulk Actions", expanded=False):
+        st.checkbox(f"Apply to all {len(df_display):,} displayed masons", key="bulk_all")
+        if not st.session_state["bulk_all"]:
+            picks = df_display.iloc[:BULK_PICK_LIMIT]
+            labels = dict(zip(
+                picks["S.NO"].tolist(),
+                ("#" + _as_text(picks["S.NO"]) + " · " + _as_text(picks["MASON NAME"])
+                 + " · " + _as_text(picks["Location"])).tolist(),
+            ))
+            # Drop picks that the current filters no longer show
+            st.session_state["bulk_snos"] = [
+                sno for sno in st.session_state.get("bulk_snos", []) if sno in labels
+            ]
+            st.multiselect(
+                "Masons", list(labels), key="bulk_snos",
+                format_func=labels.get, placeholder="Choose masons",
+            )
+            if len(df_display) > BULK_PICK_LIMIT:
+                st.caption(f"Only the first {BULK_PICK_LIMIT:,} displayed masons are listed; "
+                           "narrow the filters or apply to all displayed.")
+
+        selected = len(df_display) if st.session_state["bulk_all"] else len(st.session_state["bulk_snos"])
+        a1, a2, a3, a4, a5 = st.columns([1, 1, 1, 1, 1])
+        with a1:
+            st.button("✅ Mark Visited", key="btn_bulk_visited", disabled=not selected,
+                      on_click=bulk_mark, args=("Visited_Status", "Visited_At"),
+                      use_container_width=True)
+        with a2:
+            st.button("📝 Mark Registered", key="btn_bulk_registered", disabled=not selected,
+                      on_click=bulk_mark, args=("Registered_Status", "Registered_At"),
+                      use_container_width=True)
+        with a3:
+            st.button("🧹 Clear Status", key="btn_bulk_clear", disabled=not selected,
+                      on_click=bulk_clear, use_container_width=True)
+        with a4:
+            st.selectbox("Category", CATEGORY_OPTIONS, key="bulk_category",
+                         format_func=lambda c: c or "Blank", label_visibility="collapsed")
+        with a5:
+            st.button("🏷️ Set Category", key="btn_bulk_category", disabled=not selected,
+                      on_click=bulk_set_category, use_container_width=True)
+
+
+def card_fragment(sno: int):
+    """render_card(sno) as its own fragment, rerunnable as "card_<sno>"."""
+    def card():
+        render_card(sno)
+    # Fragment keys are registered per function name, so give each card its own
+    card.__qualname__ = f"card_{sno}"
+    return st.fragment(card, key=f"card_{sno}")
+
+
+@st.fragment(key="directory")
+def render_directory():
+    """The paginated card list; paging reruns only this fragment."""
+    df_display = filtered_rows()
+
+    if df_display.empty:
+        st.warning("No records found matching filters.")
+        return
+
+    # ---------- PAGINATION CONTROLS ----------
+    total_cards = len(df_display)
+
+    c1, c2, c3 = st.columns([1, 1, 3])
+    with c1:
+        page_size = st.selectbox(
+            "Cards per page",
+            [10, 20, 50, 100, 200, 500],
+            index=1,
+            key="cards_page_size",
+        )
+    total_pages = max(1, math.ceil(total_cards / page_size))
+
+    with c2:
+        current_page = st.number_input(
+            "Page",
+            min_value=1,
+            max_value=total_pages,
+            value=min(st.session_state.get("cards_page", 1), total_pages),
+            step=1,
+            key="cards_page",
+        )
+
+    start_idx = (current_page - 1) * page_size
+    end_idx = start_idx + page_size
+    df_page = df_display.iloc[start_idx:end_idx]
+
+    with c3:
+        st.markdown(
+            f"<div style='margin-top:1.7rem;font-size:0.85rem;color:#6b7280;'>"
+            f"Showing <b>{start_idx + 1}</b> – <b>{min(end_idx, total_cards)}</b> of <b>{total_cards}</b> records"
+            f"</div>",
+            unsafe_allow_html=True,
+        )
+
+    st.markdown("---")
+
+    # ---------- RENDER ONLY CURRENT PAGE CARDS ----------
+    for sno in df_page["S.NO"].tolist():
+        card_fragment(int(sno))()
+
+
+# ------------ MAIN TABS ------------
+
+tab_cards, tab_graphs, tab_data = st.tabs(
+    ["📇 Mason Cards", "📈 Analytics", "📝 Data Editor"]
+)
+
+# ==========================================
+#   EDITABLE CARDS SECTION (PAGINATED)
+# ==========================================
+with tab_cards:
+    st.subheader("Mason Directory")
+    st.info("💡 **Tip:** Click a card to expand. Any change you make inside is **saved automatically**.")
+
+    if not df_display.empty:
+        render_bulk_actions(df_display)
+    render_directory()
 
 # ----- ANALYTICS TAB -----
 with tab_graphs:
     st.subheader("Data Visualizations")
 
     if not df_display.empty:
+        agg = store.aggregates(filter_conditions())
         col1, col2 = st.columns(2)
         with col1:
             st.markdown('<div class="mde-chart-card">', unsafe_allow_html=True)
             st.markdown('<div class="mde-chart-title">Masons per Location</div>', unsafe_allow_html=True)
             if "Location" in df_display.columns:
-                st.bar_chart(df_display["Location"].value_counts())
+                st.bar_chart(agg.counts("Location"))
             st.markdown('</div>', unsafe_allow_html=True)
 
         with col2:
             st.markdown('<div class="mde-chart-card">', unsafe_allow_html=True)
             st.markdown('<div class="mde-chart-title">Masons per Day</div>', unsafe_allow_html=True)
             if "DAY" in df_display.columns:
-                st.bar_chart(df_display["DAY"].value_counts())
+                st.bar_chart(agg.counts("DAY"))
             st.markdown('</div>', unsafe_allow_html=True)
 
         col3, col4 = st.columns(2)
@@ -1053,39 +3179,103 @@ with tab_graphs:
             st.markdown('<div class="mde-chart-title">Product Popularity</div>', unsafe_allow_html=True)
             available = [c for c in hw_cols if c in df_display.columns]
             if available:
-                counts = df_display[available].apply(
-                    lambda x: x.astype(str).str.contains("YES", case=False).sum()
-                )
-                st.bar_chart(counts)
+                st.bar_chart(pd.Series(agg.products)[available])
             st.markdown('</div>', unsafe_allow_html=True)
 
         with col4:
             st.markdown('<div class="mde-chart-card">', unsafe_allow_html=True)
             st.markdown('<div class="mde-chart-title">Category Distribution</div>', unsafe_allow_html=True)
             if "Category" in df_display.columns:
-                st.bar_chart(df_display["Category"].value_counts())
+                st.bar_chart(agg.counts("Category"))
             st.markdown('</div>', unsafe_allow_html=True)
 
+    # ---------- MONTH-OVER-MONTH TRENDS (all snapshots) ----------
+    st.markdown("---")
+    st.markdown("#### 📅 Month-over-Month Trends")
+
+    snapshots = load_snapshot_manifest()
+    if not snapshots:
+        st.caption("Trends appear here once monthly snapshots have been saved.")
+    else:
+        t1, t2 = st.columns(2)
+        with t1:
+            trend_dimension = st.selectbox(
+                "Breakdown by", ["Location", "DLR NAME", "Product"], key="trend_dimension"
+            )
+        with t2:
+            trend_metric = st.radio(
+                "Rate", ["Visited", "Registered"], horizontal=True, key="trend_metric"
+            )
+
+        trends = snapshot_trends(snapshots, *store.snapshot())
+        view = trends[trends["dimension"] == trend_dimension]
+        rate = view[trend_metric.lower()] / view["masons"].where(view["masons"] > 0) * 100
+        st.markdown(
+            f'<div class="mde-chart-title">{trend_metric} rate (%) per {trend_dimension}</div>',
+            unsafe_allow_html=True,
+        )
+        st.line_chart(view.assign(rate=rate.round(1)).pivot_table(
+            index="month", columns="value", values="rate"
+        ))
+
+def editor_frame(rows: pd.DataFrame) -> pd.DataFrame:
+    """A copy of rows the way the editor shows them."""
+    edit_df = rows.copy()
+
+    # Make sure CONTACT NUMBER is string so edits don't break
+    if "CONTACT NUMBER" in edit_df.columns:
+        edit_df["CONTACT NUMBER"] = edit_df["CONTACT NUMBER"].map(format_contact).astype(object)
+
+    # Free-text editing for categorical columns (new values are allowed)
+    for col in CATEGORY_COLUMNS:
+        if col in edit_df.columns:
+            edit_df[col] = edit_df[col].astype(str)
+    return edit_df
+
 # ----- DATA EDITOR TAB -----
 with tab_data:
     st.subheader("Raw Data Table (Editable)")
 
     column_config = {
         "CONTACT NUMBER": st.column_config.TextColumn("Contact"),
-        "HW305": st.column_config.TextColumn("HW305", width="small"),
-        "HW101": st.column_config.TextColumn("HW101", width="small"),
-        "Hw201": st.column_config.TextColumn("Hw201", width="small"),
-        "HW103": st.column_config.TextColumn("HW103", width="small"),
-        "HW302": st.column_config.TextColumn("HW302", width="small"),
-        "HW310": st.column_config.TextColumn("HW310", width="small"),
+        "HW305": st.column_config.CheckboxColumn("HW305", width="small"),
+        "HW101": st.column_config.CheckboxColumn("HW101", width="small"),
+        "Hw201": st.column_config.CheckboxColumn("Hw201", width="small"),
+        "HW103": st.column_config.CheckboxColumn("HW103", width="small"),
+        "HW302": st.column_config.CheckboxColumn("HW302", width="small"),
+        "HW310": st.column_config.CheckboxColumn("HW310", width="small"),
     }
 
-    # Work on the currently filtered data
-    edit_df = df_display.copy()
-
-    # Make sure CONTACT NUMBER is string so edits don't break
-    if not edit_df.empty and "CONTACT NUMBER" in edit_df.columns:
-        edit_df["CONTACT NUMBER"] = edit_df["CONTACT NUMBER"].astype(str)
+    # Edits are positional, so while any are pending the editor keeps the
+    # rows it started from; saving merges them with newer changes. Until
+    # the first edit only the S.NOs on screen are kept, not a copy of them.
+    pending = st.session_state.get("data_editor") or {}
+    editing = any(pending.get(k) for k in ("edited_rows", "added_rows", "deleted_rows"))
+    shown_snos = st.session_state.get("editor_shown")
+    if editing and "editor_base" not in st.session_state and shown_snos is not None:
+        base_version, rows = store.rows(shown_snos.tolist())
+        if len(rows) < len(shown_snos):
+            # A row deleted since it was shown keeps its place, blank, so
+            # the pending edits still land on the rows they were made on
+            present = np.isin(shown_snos, rows["S.NO"].to_numpy())
+            labels = np.arange(len(store.df), len(store.df) + len(shown_snos))
+            labels[present] = rows.index
+            rows = rows.set_axis(labels[present]).reindex(labels)
+            rows["S.NO"] = shown_snos
+        st.session_state["editor_base"] = (editor_frame(rows), base_version)
+
+    if editing and "editor_base" in st.session_state:
+        edit_df, base_version = st.session_state["editor_base"]
+        if base_version != store.version:
+            st.caption("Showing the rows as they were when you started editing; "
+                       "saving merges your changes with newer ones.")
+    else:
+        # Work on the currently filtered data
+        st.session_state.pop("editor_base", None)
+        base_version = store.version
+        edit_df = editor_frame(df_display)
+        if "S.NO" in df_display.columns:
+            st.session_state["editor_shown"] = df_display["S.NO"].to_numpy(copy=True)
 
     # Show editor and capture edits
     edited_df = st.data_editor(
@@ -1105,51 +3295,53 @@ with tab_data:
         elif "S.NO" not in edit_df.columns or "S.NO" not in edited_df.columns:
             st.error("Cannot save changes because 'S.NO' column is missing.")
         else:
-            # Use S.NO as primary key
-            orig_visible = edit_df.set_index("S.NO")
-            edited_visible = edited_df.set_index("S.NO")
-
-            # Full dataset
-            main = st.session_state["data"].copy()
-            if "S.NO" not in main.columns:
-                st.error("Main data has no 'S.NO' column. Cannot sync edits.")
+            master = store.df
+            edited = edited_df.copy()
+
+            # New rows get an S.NO unless they bring one that is still free
+            snos = pd.to_numeric(edited["S.NO"], errors="coerce")
+            is_new = ~snos.isin(edit_df["S.NO"])
+            taken = store.locate(snos[is_new].dropna().astype(int).tolist())
+            fresh = is_new & (snos.isna() | snos.isin(list(taken)))
+            if fresh.any():
+                brought = snos[~fresh].max()
+                start = store.allocate_snos(fresh.sum(), above=brought if pd.notna(brought) else 0)
+                snos[fresh] = np.arange(start, start + fresh.sum())
+            edited["S.NO"] = snos
+
+            # Both sides in the master schema, indexed by master row position;
+            # rows added in the editor go after the last master row
+            before = clean_dataframe(edit_df)
+            after = clean_dataframe(edited)
+            position_of = pd.Series(edit_df.index, index=edit_df["S.NO"].to_numpy())
+            position_of = position_of[~position_of.index.duplicated(keep="last")]
+            positions = after["S.NO"].map(position_of)
+            added = positions.isna()
+            positions[added] = len(master) + np.arange(added.sum())
+            after.index = positions.astype(int).to_numpy()
+
+            # Exact changeset: modified cells, inserted rows, deleted rows
+            changes = diff_frames("Data Editor save", before, after)
+            if not changes:
+                st.info("No changes to save.")
             else:
-                main = main.set_index("S.NO")
-
-                # 1️⃣ Deletions: rows that were visible but no longer exist
-                to_delete = set(orig_visible.index) - set(edited_visible.index)
-                if to_delete:
-                    main = main.drop(index=list(to_delete), errors="ignore")
-
-                # 2️⃣ Updates: rows that still exist (overwrite visible columns)
-                common_ids = list(set(orig_visible.index) & set(edited_visible.index))
-                if common_ids:
-                    # Align columns that exist in both
-                    common_cols = [
-                        c for c in edited_visible.columns if c in main.columns
-                    ]
-                    main.loc[common_ids, common_cols] = edited_visible.loc[
-                        common_ids, common_cols
-                    ]
-
-                # 3️⃣ New rows: present in edited table, not in original visible set
-                new_ids = list(set(edited_visible.index) - set(orig_visible.index))
-                if new_ids:
-                    new_rows = edited_visible.loc[new_ids].reset_index()  # includes S.NO
-                    main_reset = main.reset_index()  # bring S.NO back as a column
-                    main_reset = pd.concat([main_reset, new_rows], ignore_index=True)
-                    main = main_reset.set_index("S.NO")
-
-                # Save back to session + disk
-                st.session_state["data"] = main.reset_index()
-                write_sheet(st.session_state["data"].copy(), GOOGLE_SHEET_ID, SHEET_TAB_NAME)
-
+                done, conflicts = changes.apply(store, base_version)
+                st.session_state["journal"].record(done)
+                report_conflicts(conflicts)
+                keyed = set(done.cells.loc[done.cells["column"].isin(UNIQUE_COLUMNS), "S.NO"])
+                if done.added is not None:
+                    keyed.update(done.added["S.NO"].tolist())
+                report_duplicates(keyed)
+                # Start the next edit from the merged data
+                del st.session_state["data_editor"]
                 st.success("Changes from Data Editor saved.")
                 st.rerun()
 
-    if not st.session_state["data"].empty:
+    if not store.df.empty:
         st.download_button(
             "📥 Download Full Current Report (All Masons)",
-            to_excel(st.session_state["data"]),
+            current_export,
             "mason_full_report.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore",
         )
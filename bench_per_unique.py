@@ -0,0 +1,154 @@
+"""
+Benchmark of clean_dataframe's per-unique cleaning against the applymap
+version it replaced, at 10k, 100k and 1M rows. Also checks that both give
+the same cells, types included.
+
+    python bench_per_unique.py [rows ...]
+
+app.py is a Streamlit script, so the schema helpers are taken from its
+SCHEMA section instead of importing it.
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SOURCE = (Path(__file__).parent / "app.py").read_text()
+app = {"np": np, "pd": pd}
+exec(SOURCE[SOURCE.index("# ------------ SCHEMA ------------"):SOURCE.index("def get_template_excel")], app)
+
+COLUMNS = [
+    "S.NO", "MASON CODE", "MASON NAME", "CONTACT NUMBER",
+    "DLR NAME", "Location", "DAY", "Category",
+    "HW305", "HW101", "Hw201", "HW103", "HW302", "HW310", "other",
+    "Visited_Status", "Visited_At", "Registered_Status", "Registered_At",
+]
+
+# ------------ BEFORE: one Python call per cell ------------
+
+def old_as_text(s: pd.Series) -> pd.Series:
+    s = s.astype(object)
+    return s.where(s.notna(), "").astype(str)
+
+def old_as_flag(s: pd.Series, label: str, exact: bool) -> pd.Series:
+    if s.dtype == bool:
+        return s
+    text = old_as_text(s).str.upper()
+    hit = text.eq(label.upper()) if exact else text.str.contains(label.upper(), regex=False)
+    return hit | text.eq("TRUE")
+
+def old_normalize_contact(s: pd.Series) -> pd.Series:
+    digits = (
+        old_as_text(s)
+        .str.replace(r"\.0$", "", regex=True)
+        .str.replace(r"\D", "", regex=True)
+    )
+    digits = digits.where(digits.str.len().between(1, 15))
+    return pd.to_numeric(digits, errors="coerce").astype("Int64")
+
+def old_strip(df: pd.DataFrame) -> pd.DataFrame:
+    return df.map(lambda x: x.strip() if isinstance(x, str) else x)
+
+def old_clean(df: pd.DataFrame) -> pd.DataFrame:
+    df.columns = [str(c).strip() for c in df.columns]
+    df = old_strip(df)
+    for col in app["STATUS_LABELS"]:
+        if col not in df.columns:
+            df[col] = False
+    for col in app["DATE_COLUMNS"]:
+        if col not in df.columns:
+            df[col] = pd.NaT
+    for col in df.columns:
+        if col == "S.NO":
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype(int)
+        elif col in app["HW_COLUMNS"]:
+            df[col] = old_as_flag(df[col], "YES", exact=False)
+        elif col in app["STATUS_LABELS"]:
+            df[col] = old_as_flag(df[col], app["STATUS_LABELS"][col], exact=True)
+        elif col in app["DATE_COLUMNS"]:
+            if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = pd.to_datetime(old_as_text(df[col]), errors="coerce", format="mixed")
+        elif col in app["CATEGORY_COLUMNS"]:
+            df[col] = old_as_text(df[col]).astype("category")
+        elif col == "CONTACT NUMBER":
+            df[col] = old_normalize_contact(df[col])
+        else:
+            df[col] = old_as_text(df[col])
+    return df
+
+# ------------ DATA ------------
+
+def sample(rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    A raw upload as the Excel reader hands it over: object columns, a third
+    of the text cells padded with spaces, unique names, a MASON CODE column
+    mixing ints and strings, and an "other" column mixing equal values of
+    different types (5 / 5.0 / True / "5") with None and NaN blanks.
+    """
+    rng = np.random.default_rng(seed)
+
+    def pick(values):
+        return np.asarray(values, dtype=object)[rng.integers(0, len(values), rows)]
+
+    def pad(values):
+        values = np.asarray(values, dtype=object)
+        padded = rng.random(rows) < 1 / 3
+        values[padded] = [f"  {v} " for v in values[padded]]
+        return values
+
+    n = np.arange(1, rows + 1)
+    codes = np.where(n % 2 == 0, n, np.char.add("MC", n.astype(str))).astype(object)
+    codes[n % 2 == 0] = n[n % 2 == 0].tolist()
+    contacts = pick([9000000000 + i for i in range(1000)] + ["90000 00001", "abc", None])
+    dates = pick(["2024-05-01", "2024-05-02", " 2024-05-03", None])
+    data = {
+        "S.NO": n.tolist(),
+        "MASON CODE": codes,
+        "MASON NAME": pad([f"Mason {i}" for i in n]),
+        "CONTACT NUMBER": contacts,
+        "DLR NAME": pad(pick([f"DLR {i}" for i in range(40)])),
+        "Location": pad(pick([f"Town {i}" for i in range(200)])),
+        "DAY": pad(pick(["MONDAY", "TUESDAY", "WEDNESDAY", "THURSDAY", "FRIDAY", "SATURDAY"])),
+        "Category": pad(pick(["E", "M", "Other", ""])),
+        **{col: pad(pick(["YES", "", "no"])) for col in app["HW_COLUMNS"]},
+        "other": pick([5, 5.0, True, 1, "5", " 5 ", None, np.nan, "note"]),
+        "Visited_Status": pad(pick(["Visited", ""])),
+        "Visited_At": dates,
+        "Registered_Status": pad(pick(["Registered", ""])),
+        "Registered_At": dates,
+    }
+    return pd.DataFrame(data, columns=COLUMNS)
+
+# ------------ RUN ------------
+
+def timed(func, df: pd.DataFrame):
+    df = df.copy()
+    start = time.perf_counter()
+    out = func(df)
+    return out, (time.perf_counter() - start) * 1000
+
+def assert_same_cells(a: pd.DataFrame, b: pd.DataFrame):
+    """Equal frames whose object columns also hold the same type in every cell."""
+    pd.testing.assert_frame_equal(a, b)
+    for col in a.select_dtypes(include="object").columns:
+        if not a[col].map(type).equals(b[col].map(type)):
+            raise AssertionError(f"{col}: cell types differ")
+
+def main(sizes: list[int]):
+    print("|      rows | applymap strip | per-unique strip | speedup | old clean | new clean | speedup |")
+    print("|-----------|----------------|------------------|---------|-----------|-----------|---------|")
+    for rows in sizes:
+        raw = sample(rows)
+        old_s, old_s_ms = timed(old_strip, raw)
+        new_s, new_s_ms = timed(app["_strip_strings"], raw)
+        assert_same_cells(old_s, new_s)
+        old_c, old_c_ms = timed(old_clean, raw)
+        new_c, new_c_ms = timed(app["clean_dataframe"], raw)
+        assert_same_cells(old_c, new_c)
+        print(f"| {rows:>9,} | {old_s_ms:>11.0f} ms | {new_s_ms:>13.0f} ms | {old_s_ms / new_s_ms:>6.1f}x "
+              f"| {old_c_ms:>6.0f} ms | {new_c_ms:>6.0f} ms | {old_c_ms / new_c_ms:>6.1f}x |")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 1_000_000])